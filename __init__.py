@@ -1,15 +1,28 @@
 #The COPYRIGHT file at the top level of this repository contains the full
 #copyright notices and license terms.
 from trytond.pool import Pool
-from . import purchase
+from . import party, product, purchase
 
 
 def register():
     Pool.register(
+        party.Party,
+        party.PartyPurchaseMinimumAmount,
+        product.Uom,
+        product.Template,
+        product.Product,
         purchase.ProductSupplier,
+        purchase.ImportMinimumQuantityStart,
+        purchase.ImportMinimumQuantityResult,
+        purchase.ExportMinimumQuantityResult,
         purchase.PurchaseRequest,
+        purchase.Purchase,
+        purchase.CreatePurchaseQueued,
         purchase.PurchaseLine,
+        purchase.MinimumQuantityShortfall,
         module='stock_supply_minimum', type_='model')
     Pool.register(
         purchase.CreatePurchase,
+        purchase.ImportMinimumQuantity,
+        purchase.ExportMinimumQuantity,
         module='stock_supply_minimum', type_='wizard')
@@ -0,0 +1,153 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import functools
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+from weakref import WeakKeyDictionary
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+logger = logging.getLogger(__name__)
+_statistics = WeakKeyDictionary()
+_query_counters = WeakKeyDictionary()
+
+
+def enabled():
+    return config.getboolean(
+        'stock_supply_minimum', 'instrumentation', default=False)
+
+
+def get_statistics(transaction=None):
+    """Return the counters of the transaction
+
+    They are logged once when the transaction ends.
+    """
+    if transaction is None:
+        transaction = Transaction()
+    statistics = _statistics.get(transaction)
+    if statistics is None:
+        statistics = _statistics[transaction] = Counter()
+        transaction.atexit(_log_statistics, statistics)
+    return statistics
+
+
+def _log_statistics(statistics):
+    if statistics:
+        logger.debug('statistics: %s', dict(sorted(statistics.items())))
+
+
+def count(name, value=1):
+    "Increment the counter name of the current transaction"
+    if enabled():
+        get_statistics()[name] += value
+
+
+class _CountingCursor:
+    "Proxy of a cursor which counts its executions"
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._cursor.__exit__(*args)
+
+
+class _QueryCounter:
+    """Count the queries executed by the cursors of the connection
+
+    The cursor method of the connection is shadowed for the time of the
+    count, so only the transaction of the connection is counted and no global
+    state is changed.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.count = 0
+
+    def install(self):
+        cursor = self.connection.cursor
+
+        def counting_cursor(*args, **kwargs):
+            return _CountingCursor(cursor(*args, **kwargs), self)
+        try:
+            self.connection.cursor = counting_cursor
+        except AttributeError:
+            # The connection does not accept attributes
+            logger.warning('queries can not be counted on %s',
+                type(self.connection).__name__)
+            self.installed = False
+        else:
+            self.installed = True
+
+    def uninstall(self):
+        if self.installed:
+            del self.connection.cursor
+
+
+@contextmanager
+def count_queries(transaction=None):
+    """Yield a list whose first item is set to the number of queries executed
+    by the transaction in the block
+
+    The blocks can be nested, the cursor is hooked by the outermost.
+    """
+    if transaction is None:
+        transaction = Transaction()
+    counter = _query_counters.get(transaction)
+    outermost = counter is None
+    if outermost:
+        counter = _query_counters[transaction] = _QueryCounter(
+            transaction.connection)
+        counter.install()
+    result = [0]
+    start = counter.count
+    try:
+        yield result
+    finally:
+        result[0] = counter.count - start
+        if outermost:
+            counter.uninstall()
+            del _query_counters[transaction]
+
+
+def instrument(name):
+    "Count the calls, the time spent and the queries of the decorated function"
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            statistics = get_statistics()
+            statistics['%s.calls' % name] += 1
+            queries = [0]
+            start = time.perf_counter()
+            try:
+                with count_queries() as queries:
+                    return func(*args, **kwargs)
+            finally:
+                statistics['%s.time' % name] += time.perf_counter() - start
+                statistics['%s.queries' % name] += queries[0]
+        return wrapper
+    return decorator
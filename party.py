@@ -0,0 +1,58 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.model import ModelSQL, fields
+from trytond.modules.company.model import (
+    CompanyMultiValueMixin, CompanyValueMixin)
+from trytond.modules.currency.fields import Monetary
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+
+
+class Party(CompanyMultiValueMixin, metaclass=PoolMeta):
+    __name__ = 'party.party'
+    purchase_minimum_amount = fields.MultiValue(Monetary(
+            "Purchase Minimum Amount",
+            currency='purchase_minimum_amount_currency',
+            digits='purchase_minimum_amount_currency',
+            help="The minimum untaxed amount of the purchases to this "
+            "supplier in the company currency"))
+    purchase_minimum_amounts = fields.One2Many(
+        'party.party.purchase_minimum_amount', 'party',
+        "Purchase Minimum Amounts")
+    purchase_minimum_amount_currency = fields.Function(fields.Many2One(
+            'currency.currency', "Purchase Minimum Amount Currency"),
+        'on_change_with_purchase_minimum_amount_currency')
+
+    @classmethod
+    def multivalue_model(cls, field):
+        pool = Pool()
+        if field == 'purchase_minimum_amount':
+            return pool.get('party.party.purchase_minimum_amount')
+        return super().multivalue_model(field)
+
+    @fields.depends()
+    def on_change_with_purchase_minimum_amount_currency(self, name=None):
+        pool = Pool()
+        Company = pool.get('company.company')
+        company_id = Transaction().context.get('company')
+        if company_id is not None and company_id >= 0:
+            return Company(company_id).currency
+
+
+class PartyPurchaseMinimumAmount(ModelSQL, CompanyValueMixin):
+    "Party Purchase Minimum Amount"
+    __name__ = 'party.party.purchase_minimum_amount'
+    party = fields.Many2One('party.party', "Party", ondelete='CASCADE',
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'})
+    purchase_minimum_amount = Monetary("Purchase Minimum Amount",
+        currency='currency', digits='currency')
+    currency = fields.Function(fields.Many2One(
+            'currency.currency', "Currency"), 'on_change_with_currency')
+
+    @fields.depends('company')
+    def on_change_with_currency(self, name=None):
+        return self.company.currency if self.company else None
@@ -0,0 +1,106 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from .instrumentation import count
+
+
+class Uom(metaclass=PoolMeta):
+    __name__ = 'product.uom'
+
+    @classmethod
+    def compute_qtys(cls, values, round=True):
+        """Convert the list of (from_uom, qty, to_uom) values
+
+        The units may be instances or ids. The conversion of each pair of
+        units is resolved once and applied with the same operations and
+        rounding as compute_qty.
+        """
+        values = list(values)
+        uoms = cls.browse(list({int(u) for f, _, t in values
+                    for u in (f, t) if u is not None}))
+        uoms = {u.id: u for u in uoms}
+
+        converters = {}
+
+        def converter(from_uom, to_uom):
+            if from_uom.category != to_uom.category:
+                return lambda qty: cls.compute_qty(
+                    from_uom, qty, to_uom, round=round)
+            if from_uom.accurate_field == 'factor':
+                from_factor, from_rate = from_uom.factor, None
+            else:
+                from_factor, from_rate = None, from_uom.rate
+            if to_uom.accurate_field == 'factor':
+                to_factor, to_rate = to_uom.factor, None
+            else:
+                to_factor, to_rate = None, to_uom.rate
+
+            def convert(qty):
+                if from_factor is not None:
+                    amount = qty * from_factor
+                else:
+                    amount = qty / from_rate
+                if to_factor is not None:
+                    amount = amount / to_factor
+                else:
+                    amount = amount * to_rate
+                if round:
+                    amount = to_uom.round(amount)
+                return amount
+            return convert
+
+        result = []
+        for from_uom, qty, to_uom in values:
+            if from_uom is not None:
+                from_uom = uoms[int(from_uom)]
+            if to_uom is not None:
+                to_uom = uoms[int(to_uom)]
+            if not qty or from_uom is None or to_uom is None:
+                result.append(cls.compute_qty(
+                        from_uom, qty, to_uom, round=round))
+                continue
+            key = (from_uom.id, to_uom.id)
+            if key not in converters:
+                converters[key] = converter(from_uom, to_uom)
+            result.append(converters[key](qty))
+        return result
+
+
+class Template(metaclass=PoolMeta):
+    __name__ = 'product.template'
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        ProductSupplier = pool.get('purchase.product_supplier')
+        actions = iter(args)
+        purchase_uom_changed = any('purchase_uom' in values
+            for _, values in zip(actions, actions))
+        super().write(*args)
+        if purchase_uom_changed:
+            # The supplier minimums are cached with the purchase unit
+            ProductSupplier._minimum_quantity_cache.clear()
+
+    @classmethod
+    def refresh_minimum_quantity(cls, templates):
+        "Refresh the minimum quantity of the open documents of the templates"
+        pool = Pool()
+        Product = pool.get('product.product')
+        PurchaseRequest = pool.get('purchase.request')
+        PurchaseLine = pool.get('purchase.line')
+        with Transaction().set_context(active_test=False):
+            products = Product.search([
+                    ('template', 'in', [t.id for t in templates]),
+                    ])
+        PurchaseRequest.refresh_minimum_quantity(products)
+        PurchaseLine.refresh_minimum_quantity(products)
+
+
+class Product(metaclass=PoolMeta):
+    __name__ = 'product.product'
+
+    def product_suppliers_used(self, **pattern):
+        count('product.product_suppliers_used')
+        return super().product_suppliers_used(**pattern)
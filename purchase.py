@@ -1,8 +1,109 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from trytond.model import fields
+import csv
+import io
+import logging
+import math
+import operator
+from collections import Counter, defaultdict
+from decimal import Decimal
+from itertools import islice
+from weakref import WeakKeyDictionary
+
+from sql import Asc, Cast, Literal, Null, Union, Window
+from sql.aggregate import Max, Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Abs, CurrentTimestamp, Round, RowNumber
+from sql.operators import Exists
+
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.exceptions import UserWarning
+from trytond.i18n import gettext
+from trytond.model import Index, ModelSQL, ModelView, fields
+from trytond.model.exceptions import DomainValidationError
+from trytond.modules.currency.fields import Monetary
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import If, Bool, Eval
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction, without_check_access
+from trytond.wizard import Button, StateTransition, StateView, Wizard
+
+from .instrumentation import count, instrument
+
+logger = logging.getLogger(__name__)
+MULTIPLE_DIGITS = 6
+MULTIPLE_PRECISION = 10 ** -MULTIPLE_DIGITS
+# The supplier minimums fetched by the create purchase wizard per transaction
+_prefetched_minimums = WeakKeyDictionary()
+_OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda a, b: a in b,
+    'not in': lambda a, b: a not in b,
+    }
+
+
+def refresh_mode():
+    """Return how the open documents are refreshed: 'flag', 'adjust' or None
+    when they are not refreshed"""
+    return config.get('stock_supply_minimum', 'refresh_minimum_quantity',
+        default=None) or None
+
+
+def store_minimum_quantity():
+    "Return if the supplier minimum quantity is stored on the requests"
+    return config.getboolean('stock_supply_minimum',
+        'store_minimum_quantity', default=False)
+
+
+def round_quantity(quantity, minimum_quantity=None, purchase_multiple=None):
+    "Return quantity raised to the minimum and to the next multiple"
+    if minimum_quantity:
+        quantity = max(quantity, minimum_quantity)
+    if purchase_multiple:
+        multiple = round(quantity / purchase_multiple, MULTIPLE_DIGITS)
+        quantity = math.ceil(multiple) * purchase_multiple
+    return quantity
+
+
+def supplier_cost(quantity, candidate, lead_time_weight=0):
+    """Return the sort key of the cost of ordering quantity from candidate
+
+    candidate is a (minimum_quantity, purchase_multiple, lead_time, prices)
+    tuple as returned by PurchaseRequest.supplier_candidates.
+    """
+    minimum_quantity, purchase_multiple, lead_time, prices = candidate
+    ordered = round_quantity(quantity, minimum_quantity, purchase_multiple)
+    unit_price = None
+    for price_quantity, price in prices:
+        if price_quantity > ordered:
+            break
+        unit_price = price
+    amount = ordered * float(unit_price if unit_price is not None else 1)
+    amount *= 1 + lead_time_weight * lead_time
+    return (unit_price is None, amount, ordered, lead_time)
+
+
+def convert_quantity_sql(quantity, from_uom, to_uom):
+    """Return the SQL expression converting quantity between uom tables
+
+    It uses the accurate field of each unit like compute_qty.
+    """
+    amount = Case((from_uom.accurate_field == 'factor',
+            quantity * from_uom.factor),
+        else_=quantity / from_uom.rate)
+    amount = Case((to_uom.accurate_field == 'factor',
+            amount / to_uom.factor),
+        else_=amount * to_uom.rate)
+    return Case((from_uom.category == to_uom.category,
+            Round(amount / to_uom.rounding) * to_uom.rounding),
+        else_=quantity)
 
 
 class ProductSupplier(metaclass=PoolMeta):
@@ -13,6 +114,39 @@ class ProductSupplier(metaclass=PoolMeta):
     minimum_quantity = fields.Float('Minimum Quantity',
         digits=(16, Eval('purchase_uom_digits', 2)),
         depends=['purchase_uom_digits'])
+    purchase_multiple = fields.Float('Purchase Multiple',
+        digits=(16, Eval('purchase_uom_digits', 2)),
+        domain=['OR',
+            ('purchase_multiple', '=', None),
+            ('purchase_multiple', '>', 0),
+            ],
+        depends=['purchase_uom_digits'],
+        help='The quantity must be a multiple of this value')
+    _minimum_quantity_cache = Cache(
+        'purchase.product_supplier.minimum_quantity', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        include = [t.minimum_quantity, t.sequence]
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.template, Index.Equality()),
+                    (t.party, Index.Equality()),
+                    (t.company, Index.Equality()),
+                    include=include,
+                    where=t.product == Null),
+                Index(t,
+                    (t.product, Index.Equality()),
+                    (t.party, Index.Equality()),
+                    (t.company, Index.Equality()),
+                    include=include,
+                    where=t.product != Null),
+                })
+        cls.__rpc__.update({
+                'lookup_minimum_quantities': RPC(readonly=True),
+                })
 
     @fields.depends('product', '_parent_product.purchase_uom')
     def on_change_with_purchase_uom_digits(self, name=None):
@@ -20,58 +154,1009 @@ class ProductSupplier(metaclass=PoolMeta):
             return self.product.purchase_uom.digits
         return 2
 
+    @classmethod
+    def create(cls, vlist):
+        product_suppliers = super().create(vlist)
+        cls.minimum_quantity_changed(
+            {p.template.id for p in product_suppliers})
+        return product_suppliers
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        templates = set()
+        for product_suppliers, values in zip(actions, actions):
+            if values.keys() & {'minimum_quantity', 'purchase_multiple',
+                    'template', 'product', 'party', 'company', 'sequence',
+                    'active'}:
+                templates.update(p.template.id for p in product_suppliers)
+                if values.get('template'):
+                    templates.add(values['template'])
+        super().write(*args)
+        cls.minimum_quantity_changed(templates)
+
+    @classmethod
+    def delete(cls, product_suppliers):
+        templates = {p.template.id for p in product_suppliers}
+        super().delete(product_suppliers)
+        cls.minimum_quantity_changed(templates)
+
+    @classmethod
+    def minimum_quantity_changed(cls, template_ids):
+        "Refresh the open documents of the templates"
+        pool = Pool()
+        Template = pool.get('product.template')
+        if not template_ids:
+            return
+        cls._minimum_quantity_cache.clear()
+        if not store_minimum_quantity() and not refresh_mode():
+            return
+        templates = Template.browse(list(template_ids))
+        if config.getboolean('stock_supply_minimum',
+                'refresh_minimum_quantity_queue', default=False):
+            with Transaction().set_context(queue_name='purchase'):
+                Template.__queue__.refresh_minimum_quantity(templates)
+        else:
+            Template.refresh_minimum_quantity(templates)
+
+    @classmethod
+    def minimum_quantity_query(cls, product_ids=None):
+        """Return a query with the minimum quantity used for each product
+
+        The query returns the columns product, party, company,
+        minimum_quantity, purchase_uom and purchase_multiple keeping only the
+        first product supplier in the order used by product_suppliers_used.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        product_supplier = cls.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+
+        condition = product_supplier.party != Null
+        if 'active' in cls._fields:
+            condition &= product_supplier.active == True
+        if product_ids is not None:
+            condition &= fields.SQL_OPERATORS['in'](
+                product.id, list(product_ids))
+        window = Window(
+            [product.id, product_supplier.party, product_supplier.company],
+            order_by=[
+                Asc(Case((product_supplier.product == Null, 1), else_=0)),
+                Asc(Case((product_supplier.sequence == Null, 0), else_=1)),
+                product_supplier.sequence.asc,
+                product_supplier.id.asc,
+                ])
+        ranked = product_supplier.join(product, condition=(
+                (product_supplier.product == product.id)
+                | ((product_supplier.product == Null)
+                    & (product_supplier.template == product.template)))
+            ).join(template, condition=product.template == template.id
+            ).select(
+                product.id.as_('product'),
+                product_supplier.party.as_('party'),
+                product_supplier.company.as_('company'),
+                product_supplier.minimum_quantity.as_('minimum_quantity'),
+                template.purchase_uom.as_('purchase_uom'),
+                product_supplier.purchase_multiple.as_('purchase_multiple'),
+                RowNumber(window=window).as_('rank'),
+                where=condition)
+        return ranked.select(
+            ranked.product,
+            ranked.party,
+            ranked.company,
+            ranked.minimum_quantity,
+            ranked.purchase_uom,
+            ranked.purchase_multiple,
+            where=ranked.rank == 1)
+
+    @classmethod
+    @instrument('product_supplier.get_minimum_quantities')
+    def get_minimum_quantities(cls, keys):
+        """Return the minimum quantity, purchase unit and multiple of each key
+
+        keys is an iterable of (product, party, company) ids and the result
+        is a dictionary with the (minimum_quantity, purchase_uom,
+        purchase_multiple) of each key that has a product supplier.
+        The values are cached per key until a product supplier is modified.
+        """
+        cursor = Transaction().connection.cursor()
+
+        result, missing = {}, set()
+        for key in {k for k in keys if all(k)}:
+            minimum = cls._minimum_quantity_cache.get(key, -1)
+            if minimum == -1:
+                missing.add(key)
+            elif minimum is not None:
+                result[key] = minimum
+        count('product_supplier.cache_misses', len(missing))
+
+        product_ids = {k[0] for k in missing}
+        in_max = Transaction().database.IN_MAX
+        for sub_ids in grouped_slice(product_ids, in_max):
+            query = cls.minimum_quantity_query(product_ids=sub_ids)
+            cursor.execute(*query)
+            for (product_id, party_id, company_id, minimum_quantity,
+                    purchase_uom, purchase_multiple) in cursor:
+                key = (product_id, party_id, company_id)
+                if key in missing:
+                    result[key] = (
+                        minimum_quantity, purchase_uom, purchase_multiple)
+        for key in missing:
+            cls._minimum_quantity_cache.set(key, result.get(key))
+        return result
+
+    @classmethod
+    @instrument('product_supplier.lookup_minimum_quantities')
+    def lookup_minimum_quantities(cls, keys):
+        """Return the minimum quantity and purchase multiple of each key
+
+        keys is a list of (product, party, unit) ids for the company of the
+        context and the result is a list in the same order of dictionaries
+        with the minimum_quantity and purchase_multiple converted to the unit
+        or None if there is no product supplier. When unit is None or of
+        another category, the values are in the purchase unit of the product.
+        """
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        company_id = Transaction().context.get('company')
+
+        keys = [(int(product), int(party), unit and int(unit))
+            for product, party, unit in keys]
+        minimums = cls.get_minimum_quantities(
+            (product, party, company_id) for product, party, _ in keys)
+        uoms = {u.id: u for u in Uom.browse(list(
+                    {u for *_, u in keys if u}
+                    | {m[1] for m in minimums.values() if m[1]}))}
+
+        result = [None] * len(keys)
+        to_convert = []
+        for i, (product, party, unit) in enumerate(keys):
+            minimum = minimums.get((product, party, company_id))
+            if not minimum:
+                continue
+            minimum_quantity, purchase_uom, purchase_multiple = minimum
+            values = result[i] = {
+                'minimum_quantity': minimum_quantity,
+                'purchase_multiple': purchase_multiple,
+                }
+            if (not unit or not purchase_uom
+                    or uoms[unit].category != uoms[purchase_uom].category):
+                continue
+            for name, quantity in values.items():
+                if quantity:
+                    to_convert.append(((i, name),
+                            (uoms[purchase_uom], quantity, uoms[unit])))
+        quantities = Uom.compute_qtys(v for _, v in to_convert)
+        for ((i, name), _), quantity in zip(to_convert, quantities):
+            result[i][name] = quantity
+        return result
+
+    @classmethod
+    def import_minimum_quantities(cls, file, rejected, chunk_size=1000):
+        """Import the minimum quantities from the CSV file
+
+        The file has a header and each row contains the product code, the
+        party code and the minimum quantity. The rows are matched and written
+        by chunk, the last row of a product supplier wins. Missing product
+        suppliers are created for the template when it has a single variant
+        and for the variant otherwise. An empty minimum quantity clears it.
+        The rejected rows are written with the reason to the rejected CSV
+        writer. Return the number of imported and rejected rows.
+        """
+        reader = csv.reader(file)
+        next(reader, None)
+        imported = rejected_count = 0
+        while True:
+            chunk = list(islice(reader, chunk_size))
+            if not chunk:
+                break
+            chunk_rejected = cls._import_minimum_quantities(chunk)
+            for row, reason in chunk_rejected:
+                rejected.writerow(row + [reason])
+            rejected_count += len(chunk_rejected)
+            imported += len(chunk) - len(chunk_rejected)
+        return imported, rejected_count
+
+    @classmethod
+    def _import_minimum_quantities(cls, rows):
+        "Upsert the minimum quantities of rows and return the rejected rows"
+        pool = Pool()
+        Product = pool.get('product.product')
+        Party = pool.get('party.party')
+        company_id = Transaction().context.get('company')
+
+        rejected, valid = [], []
+        for row in rows:
+            try:
+                code, party_code, quantity = (v.strip() for v in row[:3])
+                quantity = float(quantity) if quantity else None
+                if quantity is not None and (
+                        not math.isfinite(quantity) or quantity < 0):
+                    raise ValueError
+            except ValueError:
+                rejected.append((row, gettext(
+                            'stock_supply_minimum.msg_import_invalid_row')))
+                continue
+            valid.append((row, code, party_code, quantity))
+
+        products = defaultdict(list)
+        for product in Product.search([
+                    ('code', 'in', list({r[1] for r in valid})),
+                    ]):
+            products[product.code].append(product)
+        parties = defaultdict(list)
+        for party in Party.search([
+                    ('code', 'in', list({r[2] for r in valid})),
+                    ]):
+            parties[party.code].append(party)
+        template_ids = list({p.template.id
+                for ps in products.values() for p in ps})
+        with Transaction().set_context(active_test=False):
+            variants = Counter(p.template.id for p in Product.search([
+                        ('template', 'in', template_ids),
+                        ]))
+        template_suppliers, variant_suppliers = {}, {}
+        for product_supplier in cls.search([
+                    ('template', 'in', template_ids),
+                    ('party', 'in', list({p.id
+                                for ps in parties.values() for p in ps})),
+                    ('company', '=', company_id),
+                    ]):
+            if product_supplier.product:
+                variant_suppliers.setdefault((product_supplier.product.id,
+                        product_supplier.party.id), product_supplier)
+            else:
+                template_suppliers.setdefault((product_supplier.template.id,
+                        product_supplier.party.id), product_supplier)
+
+        # The quantity of each product supplier to write or to create
+        to_update, to_create = {}, {}
+        for row, code, party_code, quantity in valid:
+            if len(products[code]) != 1:
+                rejected.append((row, gettext(
+                            'stock_supply_minimum.msg_import_unknown_product',
+                            code=code)))
+                continue
+            if len(parties[party_code]) != 1:
+                rejected.append((row, gettext(
+                            'stock_supply_minimum.msg_import_unknown_party',
+                            code=party_code)))
+                continue
+            product, = products[code]
+            party, = parties[party_code]
+            # The supplier of a template is shared by all its variants
+            single = variants[product.template.id] == 1
+            product_supplier = variant_suppliers.get((product.id, party.id))
+            if not product_supplier and single:
+                product_supplier = template_suppliers.get(
+                    (product.template.id, party.id))
+            if product_supplier:
+                to_update[product_supplier] = quantity
+            else:
+                to_create[(product.template.id,
+                        None if single else product.id, party.id)] = {
+                    'template': product.template.id,
+                    'product': None if single else product.id,
+                    'party': party.id,
+                    'company': company_id,
+                    'minimum_quantity': quantity,
+                    }
+        to_write = defaultdict(list)
+        for product_supplier, quantity in to_update.items():
+            if product_supplier.minimum_quantity != quantity:
+                to_write[quantity].append(product_supplier)
+        if to_write:
+            cls.write(*[x for quantity, product_suppliers in to_write.items()
+                    for x in (product_suppliers,
+                        {'minimum_quantity': quantity})])
+        if to_create:
+            cls.create(list(to_create.values()))
+        return rejected
+
+    @classmethod
+    def export_minimum_quantities(cls, file):
+        "Export the minimum quantities as CSV to the file"
+        writer = csv.writer(file)
+        writer.writerow(['product_code', 'party_code', 'minimum_quantity'])
+        ids = [p.id for p in cls.search(
+                [('minimum_quantity', '!=', None)], order=[('id', 'ASC')])]
+        in_max = Transaction().database.IN_MAX
+        for sub_ids in grouped_slice(ids, in_max):
+            for product_supplier in cls.browse(list(sub_ids)):
+                if product_supplier.product:
+                    products = [product_supplier.product]
+                else:
+                    products = product_supplier.template.products
+                for product in products:
+                    writer.writerow([product.code,
+                            product_supplier.party.code,
+                            product_supplier.minimum_quantity])
+
+
+class ImportMinimumQuantityStart(ModelView):
+    "Import Minimum Quantity"
+    __name__ = 'purchase.product_supplier.import_minimum_quantity.start'
+    file = fields.Binary("File", required=True,
+        help="CSV file with a header and the product code, the supplier code "
+        "and the minimum quantity on each row.")
+
+
+class ImportMinimumQuantityResult(ModelView):
+    "Import Minimum Quantity"
+    __name__ = 'purchase.product_supplier.import_minimum_quantity.result'
+    imported = fields.Integer("Imported", readonly=True)
+    rejected = fields.Integer("Rejected", readonly=True)
+    rejected_file = fields.Binary("Rejected Rows", readonly=True,
+        filename='rejected_filename')
+    rejected_filename = fields.Char("Rejected Filename", readonly=True)
+
+
+class ImportMinimumQuantity(Wizard):
+    "Import Minimum Quantity"
+    __name__ = 'purchase.product_supplier.import_minimum_quantity'
+    start = StateView(
+        'purchase.product_supplier.import_minimum_quantity.start',
+        'stock_supply_minimum.import_minimum_quantity_start_view_form', [
+            Button("Cancel", 'end', 'tryton-cancel'),
+            Button("Import", 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+    result = StateView(
+        'purchase.product_supplier.import_minimum_quantity.result',
+        'stock_supply_minimum.import_minimum_quantity_result_view_form', [
+            Button("Close", 'end', 'tryton-close', default=True),
+            ])
+
+    def transition_import_(self):
+        pool = Pool()
+        ProductSupplier = pool.get('purchase.product_supplier')
+        file = io.TextIOWrapper(io.BytesIO(self.start.file),
+            encoding='utf-8-sig', newline='')
+        rejected = io.StringIO(newline='')
+        imported, rejected_count = ProductSupplier.import_minimum_quantities(
+            file, csv.writer(rejected))
+        self.result.imported = imported
+        self.result.rejected = rejected_count
+        if rejected_count:
+            self.result.rejected_file = rejected.getvalue().encode('utf-8')
+            self.result.rejected_filename = 'rejected.csv'
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'imported': self.result.imported,
+            'rejected': self.result.rejected,
+            'rejected_file': getattr(self.result, 'rejected_file', None),
+            'rejected_filename': getattr(
+                self.result, 'rejected_filename', None),
+            }
+
+
+class ExportMinimumQuantityResult(ModelView):
+    "Export Minimum Quantity"
+    __name__ = 'purchase.product_supplier.export_minimum_quantity.result'
+    file = fields.Binary("File", readonly=True, filename='filename')
+    filename = fields.Char("Filename", readonly=True)
+
+
+class ExportMinimumQuantity(Wizard):
+    "Export Minimum Quantity"
+    __name__ = 'purchase.product_supplier.export_minimum_quantity'
+    start = StateTransition()
+    result = StateView(
+        'purchase.product_supplier.export_minimum_quantity.result',
+        'stock_supply_minimum.export_minimum_quantity_result_view_form', [
+            Button("Close", 'end', 'tryton-close', default=True),
+            ])
+
+    def transition_start(self):
+        return 'result'
+
+    def default_result(self, fields):
+        pool = Pool()
+        ProductSupplier = pool.get('purchase.product_supplier')
+        file = io.StringIO(newline='')
+        ProductSupplier.export_minimum_quantities(file)
+        return {
+            'file': file.getvalue().encode('utf-8'),
+            'filename': 'minimum_quantities.csv',
+            }
+
 
 class PurchaseRequest(metaclass=PoolMeta):
     __name__ = 'purchase.request'
     minimum_quantity = fields.Function(fields.Float('Minimum Quantity',
-            digits='unit'), 'on_change_with_minimum_quantity',
+            digits='unit'), 'get_minimum_quantity',
             searcher='search_minimum_quantity')
+    supplier_minimum_quantity = fields.Float('Supplier Minimum Quantity',
+        digits='unit', readonly=True,
+        help='The minimum quantity of the supplier stored in the request unit')
 
-    @fields.depends('product', 'unit', 'party')
-    def on_change_with_minimum_quantity(self, name=None):
-        Uom = Pool().get('product.uom')
-        if not self.product or not self.unit:
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.supplier_minimum_quantity, Index.Range())))
+
+    @classmethod
+    def __register__(cls, module_name):
+        super().__register__(module_name)
+        if store_minimum_quantity():
+            cls._fill_supplier_minimum_quantity()
+
+    @classmethod
+    def _fill_supplier_minimum_quantity(cls):
+        "Fill the stored minimum quantity of the pending requests"
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        from_, condition, minimum_quantity = cls._minimum_quantity_sql(table)
+        cursor.execute(*table.update(
+                [table.supplier_minimum_quantity],
+                [from_.select(minimum_quantity, where=condition)],
+                where=(table.purchase_line == Null)
+                & (table.state != 'cancelled')))
+
+    @classmethod
+    def generate_requests(cls, products=None, warehouses=None):
+        with Transaction().set_context(_generate_requests=True):
+            return super().generate_requests(
+                products=products, warehouses=warehouses)
+
+    @classmethod
+    def create(cls, vlist):
+        requests = super().create(vlist)
+        cls.update_supplier_minimum_quantity(requests)
+        if (Transaction().context.get('_generate_requests')
+                and config.getboolean('stock_supply_minimum',
+                    'generate_minimum_quantity', default=False)):
+            # The computed quantity keeps the original need
+            cls.adjust_minimum_quantity(requests)
+        return requests
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        to_update = []
+        for requests, values in zip(actions, actions):
+            if values.keys() & {'product', 'party', 'unit', 'company'}:
+                to_update.extend(requests)
+        super().write(*args)
+        cls.update_supplier_minimum_quantity(to_update)
+
+    @classmethod
+    def update_supplier_minimum_quantity(cls, requests):
+        "Store the current minimum quantity on the requests if enabled"
+        if not requests or not store_minimum_quantity():
             return
-        for product_supplier in self.product.product_suppliers_used():
-            if product_supplier.party == self.party:
-                return Uom.compute_qty(self.product.purchase_uom,
-                    product_supplier.minimum_quantity, self.unit)
+        requests = cls.browse(requests)
+        minimums = cls.get_minimum_quantity(requests, 'minimum_quantity')
+        to_write = defaultdict(list)
+        for request in requests:
+            minimum_quantity = minimums[request.id]
+            if request.supplier_minimum_quantity != minimum_quantity:
+                to_write[minimum_quantity].append(request)
+        if to_write:
+            # The stored value is not edited by the user
+            with without_check_access():
+                cls.write(*[x
+                        for minimum_quantity, requests in to_write.items()
+                        for x in (requests,
+                            {'supplier_minimum_quantity': minimum_quantity})])
 
     @classmethod
-    def search_minimum_quantity(cls, name, clause):
+    def refresh_minimum_quantity(cls, products):
+        "Refresh the minimum quantity of the pending requests of products"
+        in_max = Transaction().database.IN_MAX
+        requests = []
+        for sub_products in grouped_slice(products, in_max):
+            requests.extend(cls.search([
+                        ('product', 'in', [p.id for p in sub_products]),
+                        ('purchase_line', '=', None),
+                        ]))
+        cls.update_supplier_minimum_quantity(requests)
+        if refresh_mode() == 'adjust':
+            cls.adjust_minimum_quantity(requests)
+
+    @classmethod
+    def adjust_minimum_quantity(cls, requests):
+        "Raise the quantity of the requests to their supplier minimum"
+        requests = cls.browse(requests)
+        minimums = cls.get_minimum_quantity(requests, 'minimum_quantity')
+        to_write = defaultdict(list)
+        for request in requests:
+            minimum_quantity = minimums[request.id]
+            if minimum_quantity and request.quantity < minimum_quantity:
+                to_write[minimum_quantity].append(request)
+        if to_write:
+            with without_check_access():
+                cls.write(*[x
+                        for minimum_quantity, requests in to_write.items()
+                        for x in (requests, {'quantity': minimum_quantity})])
+
+    @classmethod
+    def supplier_candidates(cls, products):
+        """Return the candidate suppliers of the products
+
+        The result maps the (product, company) ids to a dictionary of the
+        (minimum_quantity, purchase_multiple, lead_time, prices) of each party
+        where lead_time is in days and prices are the (quantity, unit_price)
+        in the purchase unit and the company currency ordered by quantity.
+        Only the first product supplier of each party is kept in the order
+        used by product_suppliers_used.
+        """
         pool = Pool()
-        Template = pool.get('product.template')
-        Product = pool.get('product.product')
         ProductSupplier = pool.get('purchase.product_supplier')
+        Currency = pool.get('currency.currency')
+
+        variants = defaultdict(set)
+        for product in products:
+            variants[product.template.id].add(product.id)
+
+        def order(product_supplier):
+            return (product_supplier.product is None,
+                product_supplier.sequence is not None,
+                product_supplier.sequence or 0, product_supplier.id)
+
+        in_max = Transaction().database.IN_MAX
+        candidates = defaultdict(dict)
+        for templates in grouped_slice(list(variants), in_max):
+            product_suppliers = ProductSupplier.search([
+                    ('template', 'in', list(templates)),
+                    ('party', '!=', None),
+                    ('company', '!=', None),
+                    ])
+            for product_supplier in sorted(product_suppliers, key=order):
+                company = product_supplier.company
+                lead_time = product_supplier.lead_time
+                prices = []
+                for price in product_supplier.prices:
+                    unit_price = price.unit_price
+                    if product_supplier.currency != company.currency:
+                        unit_price = Currency.compute(
+                            product_supplier.currency, unit_price,
+                            company.currency, round=False)
+                    prices.append((price.quantity or 0, unit_price))
+                candidate = (
+                    product_supplier.minimum_quantity,
+                    product_supplier.purchase_multiple,
+                    lead_time.total_seconds() / 86400 if lead_time else 0,
+                    sorted(prices))
+                template_variants = variants[product_supplier.template.id]
+                if product_supplier.product:
+                    product_ids = (
+                        {product_supplier.product.id} & template_variants)
+                else:
+                    product_ids = template_variants
+                for product_id in product_ids:
+                    candidates[product_id, company.id].setdefault(
+                        product_supplier.party.id, candidate)
+        return candidates
+
+    @classmethod
+    @instrument('request.optimize_supplier')
+    def optimize_supplier(cls, requests):
+        """Assign to the requests the supplier with the lowest cost
+
+        The requests are grouped by product, company and warehouse as they
+        end on the same purchase line and each candidate supplier is weighed
+        on the total quantity of the group raised to its minimum and multiple,
+        at its price and with its lead time.
+        """
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        lead_time_weight = config.getfloat('stock_supply_minimum',
+            'optimize_supplier_lead_time', default=0)
+
+        requests = [r for r in requests
+            if r.product and r.product.purchase_uom and r.unit
+            and not r.purchase_line]
+        candidates = cls.supplier_candidates({r.product for r in requests})
+        quantities = Uom.compute_qtys(
+            (r.unit, r.quantity or 0, r.product.purchase_uom)
+            for r in requests)
+
+        groups = defaultdict(lambda: [0, []])
+        for request, quantity in zip(requests, quantities):
+            group = groups[request.product.id, request.company.id,
+                request.warehouse and request.warehouse.id]
+            group[0] += quantity
+            group[1].append(request)
+
+        to_write = defaultdict(list)
+        for (product_id, company_id, _), (quantity, group) in groups.items():
+            parties = candidates.get((product_id, company_id), {})
+            if len(parties) < 2:
+                continue
+            # Keep the current supplier of the group on equal cost
+            current = Counter(r.party.id for r in group if r.party)
+            party_id = min(parties, key=lambda p: (
+                    supplier_cost(quantity, parties[p], lead_time_weight),
+                    -current[p]))
+            to_write[party_id].extend(
+                r for r in group if not r.party or r.party.id != party_id)
+        if to_write:
+            logger.info('optimize supplier: %s requests reassigned',
+                sum(map(len, to_write.values())))
+            cls.write(*[x for party_id, requests in to_write.items()
+                    for x in (requests, {'party': party_id})])
+
+    @classmethod
+    def queue_create_purchase(cls, requests, chunk_size):
+        """Create the purchases of the requests in queued chunks and return
+        the number of chunks
+
+        The requests of a supplier are never split so the minimum quantity is
+        applied on all of them.
+        """
+        by_party = defaultdict(list)
+        for request in requests:
+            if not request.purchase_line:
+                by_party[request.party.id].append(request)
+        chunks, chunk = [], []
+        for party_requests in by_party.values():
+            if chunk and len(chunk) + len(party_requests) > chunk_size:
+                chunks.append(chunk)
+                chunk = []
+            chunk.extend(party_requests)
+        if chunk:
+            chunks.append(chunk)
+        with Transaction().set_context(queue_name='purchase'):
+            for i, chunk in enumerate(chunks, 1):
+                cls.__queue__.create_purchase_chunk(chunk, i, len(chunks))
+        return len(chunks)
+
+    @classmethod
+    def create_purchase_chunk(cls, requests, chunk, chunks):
+        "Run the create purchase wizard on a chunk of requests"
+        pool = Pool()
+        CreatePurchase = pool.get(
+            'purchase.request.create_purchase', type='wizard')
+        logger.info('create purchase chunk %s/%s: %s requests',
+            chunk, chunks, len(requests))
+        with Transaction().set_context(
+                active_model=cls.__name__,
+                active_id=requests[0].id if requests else None,
+                active_ids=[r.id for r in requests],
+                _create_purchase_chunk=True):
+            session_id, _, _ = CreatePurchase.create()
+            CreatePurchase.execute(session_id, {}, 'start')
+            CreatePurchase.delete(session_id)
+        logger.info('create purchase chunk %s/%s: done', chunk, chunks)
+
+    @fields.depends('product', 'unit', 'party', 'company')
+    def on_change_with_minimum_quantity(self, name=None):
+        return self.get_minimum_quantity([self], name)[self.id]
+
+    @classmethod
+    @instrument('request.get_minimum_quantity')
+    def get_minimum_quantity(cls, requests, name, minimums=None):
+        """Return the supplier minimum quantity of the requests in their unit
+
+        minimums is the result of ProductSupplier.get_minimum_quantities for
+        the requests when it is already known.
+        """
+        pool = Pool()
+        ProductSupplier = pool.get('purchase.product_supplier')
+        Uom = pool.get('product.uom')
+
+        key = cls._minimum_quantity_key
+        if minimums is None:
+            minimums = ProductSupplier.get_minimum_quantities(
+                key(r) for r in requests)
+        result = {r.id: None for r in requests}
+        to_convert = []
+        for request in requests:
+            minimum = minimums.get(key(request))
+            if not request.unit or not minimum:
+                continue
+            minimum_quantity, purchase_uom, _ = minimum
+            if not purchase_uom:
+                result[request.id] = minimum_quantity
+                continue
+            to_convert.append(
+                (request.id, (purchase_uom, minimum_quantity, request.unit)))
+        quantities = Uom.compute_qtys(v for _, v in to_convert)
+        for (request_id, _), quantity in zip(to_convert, quantities):
+            result[request_id] = quantity
+        return result
+
+    @staticmethod
+    def _minimum_quantity_key(request):
+        "Return the key of the request for get_minimum_quantities"
+        return (request.product and request.product.id,
+            request.party and request.party.id,
+            request.company and request.company.id)
+
+    @classmethod
+    def _minimum_quantity_sql(cls, table):
+        """Return the from item, the condition and the expression of the
+        minimum quantity converted to the unit of the request table"""
+        pool = Pool()
+        ProductSupplier = pool.get('purchase.product_supplier')
+        Uom = pool.get('product.uom')
+        from_uom = Uom.__table__()
+        to_uom = Uom.__table__()
+
+        minimum = ProductSupplier.minimum_quantity_query()
+        from_ = minimum.join(from_uom,
+            condition=minimum.purchase_uom == from_uom.id
+            ).join(to_uom, condition=to_uom.id == table.unit)
+        condition = ((minimum.product == table.product)
+            & (minimum.party == table.party)
+            & (minimum.company == table.company))
+        minimum_quantity = convert_quantity_sql(
+            minimum.minimum_quantity, from_uom, to_uom)
+        return from_, condition, minimum_quantity
+
+    @classmethod
+    @instrument('request.search_minimum_quantity')
+    def search_minimum_quantity(cls, name, clause):
         _, operator, value = clause
         Operator = fields.SQL_OPERATORS[operator]
         table = cls.__table__()
-        template = Template.__table__()
-        product = Product.__table__()
-        product_supplier = ProductSupplier.__table__()
-
-        query = table.join(product,
-            condition=(product.id == table.product)).join(template,
-                condition=(product.template == template.id)).join(
-                    product_supplier, condition=(
-                        (product_supplier.product == template.id) &
-                        (product_supplier.party == table.party))).select(
-                    table.id,
-                    where=(Operator(product_supplier.minimum_quantity,
-                            value)))
+
+        from_, condition, minimum_quantity = cls._minimum_quantity_sql(table)
+        query = table.select(table.id,
+            where=Exists(from_.select(Literal(1),
+                    where=condition & Operator(minimum_quantity, value))))
         return [('id', 'in', query)]
 
+    @classmethod
+    def order_minimum_quantity(cls, tables):
+        table, _ = tables[None]
+        from_, condition, minimum_quantity = cls._minimum_quantity_sql(table)
+        return [from_.select(minimum_quantity, where=condition)]
+
+
+class Purchase(metaclass=PoolMeta):
+    __name__ = 'purchase.purchase'
+    minimum_amount_shortfall = fields.Function(Monetary(
+            "Minimum Amount Shortfall", currency='currency',
+            digits='currency',
+            help="The amount missing to reach the supplier minimum amount."),
+        'get_minimum_amount_shortfall',
+        searcher='search_minimum_amount_shortfall')
+
+    @classmethod
+    def _minimum_amount_query(cls, where=None):
+        """Return the query of the untaxed amount and the supplier minimum
+        amount in the company currency of the draft and quotation purchases"""
+        pool = Pool()
+        Line = pool.get('purchase.line')
+        MinimumAmount = pool.get('party.party.purchase_minimum_amount')
+        purchase = cls.__table__()
+        line = Line.__table__()
+        minimum = MinimumAmount.__table__()
+
+        sql_type = MinimumAmount.purchase_minimum_amount.sql_type().base
+        amount = Coalesce(
+            Sum(Cast(line.quantity, sql_type) * line.unit_price), 0)
+        condition = (purchase.state.in_(['draft', 'quotation'])
+            & (minimum.purchase_minimum_amount != Null))
+        if where is not None:
+            condition &= where(purchase)
+        return purchase.join(minimum, condition=(
+                (minimum.party == purchase.party)
+                & (minimum.company == purchase.company))
+            ).join(line, 'LEFT', condition=(line.purchase == purchase.id)
+                & (line.type == 'line')
+            ).select(purchase.id.as_('id'),
+                minimum.purchase_minimum_amount.as_('minimum_amount'),
+                amount.as_('amount'),
+                where=condition,
+                group_by=[purchase.id, minimum.purchase_minimum_amount])
+
+    @classmethod
+    def _minimum_amount_shortfalls(cls, where=None):
+        """Return the positive shortfalls of the purchases
+
+        The minimum amount is converted to the currency of the purchase at
+        its date.
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*cls._minimum_amount_query(where=where))
+        amounts = {p: (m, a) for p, m, a in cursor}
+        shortfalls = {}
+        for purchase in cls.browse(list(amounts)):
+            minimum, amount = (
+                Decimal(str(v)) for v in amounts[purchase.id])
+            currency = purchase.company.currency
+            if currency != purchase.currency:
+                with Transaction().set_context(date=purchase.purchase_date):
+                    minimum = Currency.compute(
+                        currency, minimum, purchase.currency, round=False)
+            shortfall = purchase.currency.round(minimum - amount)
+            if shortfall > 0:
+                shortfalls[purchase.id] = shortfall
+        return shortfalls
+
+    @classmethod
+    @instrument('purchase.get_minimum_amount_shortfall')
+    def get_minimum_amount_shortfall(cls, purchases, name):
+        in_max = Transaction().database.IN_MAX
+        shortfalls = {}
+        for sub_purchases in grouped_slice(purchases, in_max):
+            sub_ids = [p.id for p in sub_purchases]
+            shortfalls.update(cls._minimum_amount_shortfalls(
+                    where=lambda purchase: fields.SQL_OPERATORS['in'](
+                        purchase.id, sub_ids)))
+        return {p.id: shortfalls.get(p.id) for p in purchases}
+
+    @classmethod
+    def search_minimum_amount_shortfall(cls, name, clause):
+        pool = Pool()
+        Company = pool.get('company.company')
+        Currency = pool.get('currency.currency')
+        purchase = cls.__table__()
+        company = Company.__table__()
+        currency = Currency.__table__()
+        _, operator, value = clause
+
+        def company_currency(purchase):
+            return purchase.currency.in_(company.select(company.currency,
+                    where=company.id == purchase.company))
+
+        # The shortfalls in the company currency are compared in SQL
+        amounts = cls._minimum_amount_query(where=company_currency)
+        shortfall = Round(
+            amounts.minimum_amount - amounts.amount, currency.digits)
+        condition = shortfall > 0
+        if value is not None:
+            condition &= fields.SQL_OPERATORS[operator](shortfall, value)
+        query = amounts.join(purchase,
+            condition=purchase.id == amounts.id
+            ).join(currency, condition=currency.id == purchase.currency
+            ).select(amounts.id, where=condition)
+
+        # and the others in Python as they are converted at the purchase date
+        shortfalls = cls._minimum_amount_shortfalls(
+            where=lambda purchase: ~company_currency(purchase))
+        if value is None:
+            if operator == '=':
+                return [
+                    ('id', 'not in', query),
+                    ('id', 'not in', list(shortfalls)),
+                    ]
+            return ['OR',
+                ('id', 'in', query),
+                ('id', 'in', list(shortfalls)),
+                ]
+        Operator = _OPERATORS[operator]
+        return ['OR',
+            ('id', 'in', query),
+            ('id', 'in', [p for p, s in shortfalls.items()
+                    if Operator(s, value)]),
+            ]
+
+    @classmethod
+    def check_minimum_amount(cls, purchases):
+        "Warn about the purchases below the supplier minimum amount"
+        pool = Pool()
+        Warning = pool.get('res.user.warning')
+        shortfalls = {p: s for p, s in cls.get_minimum_amount_shortfall(
+                purchases, 'minimum_amount_shortfall').items() if s}
+        if not shortfalls:
+            return
+        purchases = cls.browse(list(shortfalls))
+        if Transaction().context.get('_create_purchase_chunk'):
+            logger.info('%s purchases are below their supplier minimum amount',
+                len(purchases))
+            return
+        warning_name = Warning.format('minimum_amount', purchases)
+        if Warning.check(warning_name):
+            raise UserWarning(warning_name, gettext(
+                    'stock_supply_minimum.msg_purchase_minimum_amount',
+                    purchases=', '.join('%s (%s)' % (p.rec_name,
+                            shortfalls[p.id]) for p in purchases)))
+
+
+class CreatePurchaseQueued(ModelView):
+    "Create Purchase Queued"
+    __name__ = 'purchase.request.create_purchase.queued'
+    requests = fields.Integer("Requests", readonly=True)
+    chunks = fields.Integer("Chunks", readonly=True)
+
 
 class CreatePurchase(metaclass=PoolMeta):
     __name__ = 'purchase.request.create_purchase'
+    queued = StateView(
+        'purchase.request.create_purchase.queued',
+        'stock_supply_minimum.create_purchase_queued_view_form', [
+            Button("Close", 'end', 'tryton-close', default=True),
+            ])
+
+    def transition_start(self):
+        pool = Pool()
+        ProductSupplier = pool.get('purchase.product_supplier')
+        Request = pool.get('purchase.request')
+        Purchase = pool.get('purchase.purchase')
+        chunk_size = config.getint(
+            'stock_supply_minimum', 'create_purchase_chunk', default=0)
+        context = Transaction().context
+        if (config.getboolean('stock_supply_minimum', 'optimize_supplier',
+                    default=False)
+                and not context.get('_create_purchase_chunk')):
+            # Before the records are read so they get the new parties
+            Request.optimize_supplier(Request.search([
+                        ('id', 'in', [r.id for r in self.records]),
+                        ('purchase_line', '=', None),
+                        ]))
+        if (chunk_size and len(self.records) > chunk_size
+                and not context.get('_create_purchase_chunk')
+                and all(r.party for r in self.records)):
+            self.queued.requests = len(self.records)
+            self.queued.chunks = Request.queue_create_purchase(
+                self.records, chunk_size)
+            return 'queued'
+        # Fetch the minimums of all the requests in one step and keep them
+        # for compute_purchase_line as the shared cache is bounded
+        requests = Request.search([
+                ('id', 'in', [r.id for r in self.records]),
+                ('purchase_line', '=', None),
+                ])
+        keys = set(map(Request._minimum_quantity_key, requests))
+        suppliers = ProductSupplier.get_minimum_quantities(keys)
+        # Keep also the keys without product supplier
+        suppliers = {k: suppliers.get(k) for k in keys}
+        minimums = Request.get_minimum_quantity(
+            requests, 'minimum_quantity', minimums=suppliers)
+        transaction = Transaction()
+        _prefetched_minimums[transaction] = (minimums, suppliers)
+        try:
+            state = super().transition_start()
+        finally:
+            del _prefetched_minimums[transaction]
+        purchases = {r.purchase_line.purchase
+            for r in Request.browse(requests) if r.purchase_line}
+        Purchase.check_minimum_amount(list(purchases))
+        return state
+
+    def default_queued(self, fields):
+        return {
+            'requests': self.queued.requests,
+            'chunks': self.queued.chunks,
+            }
 
     @classmethod
+    @instrument('create_purchase.compute_purchase_line')
     def compute_purchase_line(cls, key, requests, purchase):
+        pool = Pool()
+        ProductSupplier = pool.get('purchase.product_supplier')
+        Request = pool.get('purchase.request')
+        Uom = pool.get('product.uom')
         line = super(CreatePurchase, cls).compute_purchase_line(key, requests,
             purchase)
-        line.quantity = max([line.quantity] + [x.minimum_quantity for x in
-                requests if x.minimum_quantity])
-        line.on_change_quantity()
+        minimums, suppliers = _prefetched_minimums.get(
+            Transaction(), ({}, {}))
+        missing = [r for r in requests if r.id not in minimums]
+        if missing:
+            minimums = {**minimums,
+                **Request.get_minimum_quantity(missing, 'minimum_quantity')}
+        quantity = max([line.quantity] + Uom.compute_qtys(
+                (x.unit, minimums[x.id], line.unit)
+                for x in requests if minimums[x.id]))
+        supplier_key = (
+            line.product.id, purchase.party.id, purchase.company.id)
+        if supplier_key in suppliers:
+            minimum = suppliers[supplier_key]
+        else:
+            minimum = ProductSupplier.get_minimum_quantities(
+                [supplier_key]).get(supplier_key)
+        if minimum:
+            _, purchase_uom, purchase_multiple = minimum
+            if purchase_multiple and purchase_uom:
+                purchase_multiple, = Uom.compute_qtys(
+                    [(purchase_uom, purchase_multiple, line.unit)])
+            quantity = line.unit.round(
+                round_quantity(quantity, purchase_multiple=purchase_multiple))
+        if quantity != line.quantity:
+            line.quantity = quantity
+            line.on_change_quantity()
         return line
 
 
@@ -82,34 +1167,384 @@ class PurchaseLine(metaclass=PoolMeta):
         digits='unit', states={
             'invisible': ~Bool(Eval('minimum_quantity')),
         }, help='The quantity must be greater or equal than minimum quantity'),
-        'on_change_with_minimum_quantity')
+        'get_minimum_quantity')
+    purchase_multiple = fields.Function(fields.Float('Purchase Multiple',
+        digits='unit', states={
+            'invisible': ~Bool(Eval('purchase_multiple')),
+        }, help='The quantity must be a multiple of this value'),
+        'get_minimum_quantity')
+    invalid_quantity = fields.Function(fields.Boolean('Invalid Quantity',
+        help='The quantity of the draft or quotation line is below the '
+        'supplier minimum quantity or not a multiple of the purchase '
+        'multiple'),
+        'get_invalid_quantity', searcher='search_invalid_quantity')
 
     @classmethod
     def __setup__(cls):
         super(PurchaseLine, cls).__setup__()
-        minimum_domain = If( Eval('purchase_state').in_(['draft', 'quotation']) & Bool(Eval('minimum_quantity', 0)),
+        # The domain is checked by check_minimum_quantity on the server
+        minimum_domain = If(Eval('purchase_state').in_(['draft', 'quotation'])
+            & Bool(Eval('minimum_quantity', 0))
+            & ~Eval('context', {}).get('_check_minimum_quantity', False),
             ('OR', ('quantity', '>=', Eval('minimum_quantity', 0)), ('quantity', '<', 0)), ())
         cls.quantity.domain.append(minimum_domain)
         cls.quantity.depends.add('minimum_quantity')
         cls.quantity.depends.add('purchase_state')
 
+    @classmethod
+    def _validate(cls, lines, field_names=None):
+        with Transaction().set_context(_check_minimum_quantity=True):
+            super()._validate(lines, field_names=field_names)
+        if (field_names is None
+                or {'quantity', 'unit', 'product', 'purchase'}
+                & set(field_names)):
+            cls.check_minimum_quantity(lines)
+
+    @classmethod
+    def invalid_quantities(cls, line_ids=None, product_ids=None):
+        """Return the quantity, minimum quantity and purchase multiple of the
+        draft and quotation lines with a quantity below the minimum or not a
+        multiple of the purchase multiple
+
+        The lines may be restricted to line_ids and product_ids.
+        """
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*cls._invalid_quantity_query(
+                line_ids=line_ids, product_ids=product_ids))
+        return {l: (q, m, p) for l, q, m, p in cursor}
+
+    @classmethod
+    def _invalid_quantity_query(cls, line_ids=None, product_ids=None):
+        "Return the query of invalid_quantities"
+        pool = Pool()
+        Purchase = pool.get('purchase.purchase')
+        ProductSupplier = pool.get('purchase.product_supplier')
+        Uom = pool.get('product.uom')
+        line = cls.__table__()
+        purchase = Purchase.__table__()
+        from_uom = Uom.__table__()
+        to_uom = Uom.__table__()
+
+        minimum = ProductSupplier.minimum_quantity_query(
+            product_ids=product_ids)
+        minimum_quantity = convert_quantity_sql(
+            minimum.minimum_quantity, from_uom, to_uom)
+        purchase_multiple = convert_quantity_sql(
+            minimum.purchase_multiple, from_uom, to_uom)
+        ratio = line.quantity / purchase_multiple
+        where = (purchase.state.in_(['draft', 'quotation'])
+            & (line.quantity >= 0)
+            & (((minimum.minimum_quantity != Null)
+                    & (minimum.minimum_quantity != 0)
+                    & (line.quantity < minimum_quantity))
+                | ((minimum.purchase_multiple != Null)
+                    & (purchase_multiple > 0)
+                    & (Abs(ratio - Round(ratio)) > MULTIPLE_PRECISION))))
+        if line_ids is not None:
+            where &= fields.SQL_OPERATORS['in'](line.id, list(line_ids))
+        if product_ids is not None:
+            where &= fields.SQL_OPERATORS['in'](
+                line.product, list(product_ids))
+        query = line.join(purchase,
+            condition=line.purchase == purchase.id
+            ).join(minimum, condition=(
+                (minimum.product == line.product)
+                & (minimum.party == purchase.party)
+                & (minimum.company == purchase.company))
+            ).join(from_uom,
+            condition=minimum.purchase_uom == from_uom.id
+            ).join(to_uom, condition=line.unit == to_uom.id
+            ).select(line.id.as_('id'), line.quantity.as_('quantity'),
+                minimum_quantity.as_('minimum_quantity'),
+                purchase_multiple.as_('purchase_multiple'), where=where)
+        return query
+
+    @classmethod
+    def get_invalid_quantity(cls, lines, name):
+        in_max = Transaction().database.IN_MAX
+        invalid = set()
+        for sub_lines in grouped_slice(lines, in_max):
+            sub_lines = list(sub_lines)
+            invalid.update(cls.invalid_quantities(
+                    line_ids=[l.id for l in sub_lines],
+                    product_ids={l.product.id for l in sub_lines
+                        if l.product}))
+        return {l.id: l.id in invalid for l in lines}
+
+    @classmethod
+    def search_invalid_quantity(cls, name, clause):
+        _, operator, value = clause
+        query = cls._invalid_quantity_query()
+        if (operator == '=') == bool(value):
+            return [('id', 'in', query.select(query.id))]
+        else:
+            return [('id', 'not in', query.select(query.id))]
+
+    @classmethod
+    @instrument('line.check_minimum_quantity')
+    def check_minimum_quantity(cls, lines):
+        in_max = Transaction().database.IN_MAX
+        invalid = {}
+        for sub_lines in grouped_slice(lines, in_max):
+            sub_lines = list(sub_lines)
+            invalid.update(cls.invalid_quantities(
+                    line_ids=[l.id for l in sub_lines],
+                    product_ids={l.product.id for l in sub_lines
+                        if l.product}))
+        if not invalid:
+            return
+        below, not_multiple = [], []
+        for line in cls.browse(list(invalid)):
+            quantity, minimum_quantity, purchase_multiple = invalid[line.id]
+            if minimum_quantity and quantity < minimum_quantity:
+                below.append('%s (%s)' % (line.rec_name, minimum_quantity))
+            else:
+                not_multiple.append(
+                    '%s (%s)' % (line.rec_name, purchase_multiple))
+        if below:
+            raise DomainValidationError(
+                gettext('stock_supply_minimum.msg_line_minimum_quantity',
+                    lines=', '.join(below)))
+        raise DomainValidationError(
+            gettext('stock_supply_minimum.msg_line_purchase_multiple',
+                lines=', '.join(not_multiple)))
+
+    @classmethod
+    def refresh_minimum_quantity(cls, products):
+        "Flag or adjust the draft lines of products below their minimum"
+        if not refresh_mode():
+            return
+        in_max = Transaction().database.IN_MAX
+        invalid = {}
+        for sub_products in grouped_slice(products, in_max):
+            invalid.update(cls.invalid_quantities(
+                    product_ids=[p.id for p in sub_products]))
+        if not invalid:
+            return
+        if refresh_mode() != 'adjust':
+            # The lines are flagged by the invalid_quantity field
+            logger.info('%s purchase lines have an invalid quantity',
+                len(invalid))
+            return
+        lines = cls.browse(list(invalid))
+        for line in lines:
+            line.quantity = line.unit.round(round_quantity(*invalid[line.id]))
+            line.on_change_quantity()
+        # The lines are adjusted on behalf of the supplier change
+        with without_check_access():
+            cls.save(lines)
+
+    # The product and the party are the key of the supplier minimum and the
+    # unit converts it, the company is read from the context when missing
     @fields.depends('product', 'purchase', '_parent_purchase.party', 'unit')
     def on_change_with_minimum_quantity(self, name=None):
-        Uom = Pool().get('product.uom')
-        if not self.product or not self.purchase or not self.purchase.party:
-            return
+        # on_change_with calls the method without name
+        return self.get_minimum_quantity(
+            [self], ['minimum_quantity'])['minimum_quantity'][self.id]
 
-        product_suppliers = list(self.product.product_suppliers_used(
-                **{'party': self.purchase.party.id}))
+    @fields.depends('product', 'purchase', '_parent_purchase.party', 'unit')
+    def on_change_with_purchase_multiple(self, name=None):
+        return self.get_minimum_quantity(
+            [self], ['purchase_multiple'])['purchase_multiple'][self.id]
 
-        if not product_suppliers:
-            return
+    @classmethod
+    @instrument('line.get_minimum_quantity')
+    def get_minimum_quantity(cls, lines, names):
+        pool = Pool()
+        ProductSupplier = pool.get('purchase.product_supplier')
+        Uom = pool.get('product.uom')
+
+        company_id = Transaction().context.get('company')
+
+        def key(line):
+            if not line.product or not line.purchase:
+                return
+            purchase = line.purchase
+            # The company is not sent by on_change
+            company = getattr(purchase, 'company', None)
+            return (line.product.id, purchase.party and purchase.party.id,
+                company.id if company else company_id)
+
+        minimums = ProductSupplier.get_minimum_quantities(
+            k for k in map(key, lines) if k)
+        result = {n: {l.id: None for l in lines} for n in names}
+        to_convert = []
+        for line in lines:
+            minimum = minimums.get(key(line))
+            if not minimum:
+                continue
+            minimum_quantity, purchase_uom, purchase_multiple = minimum
+            values = {
+                'minimum_quantity': minimum_quantity,
+                'purchase_multiple': purchase_multiple,
+                }
+            # The purchase unit of the cache avoids reading the product
+            convert = (line.unit and purchase_uom
+                and purchase_uom != line.unit.id)
+            for name in names:
+                result[name][line.id] = values[name]
+                if values[name] and convert:
+                    to_convert.append(((name, line.id),
+                            (purchase_uom, values[name], line.unit.id)))
+        uoms = {u.id: u for u in Uom.browse(
+                list({i for _, v in to_convert for i in v[::2]}))}
+        to_convert = [(k, v) for k, v in to_convert
+            if uoms[v[0]].category == uoms[v[2]].category]
+        quantities = Uom.compute_qtys(v for _, v in to_convert)
+        for ((name, line_id), _), quantity in zip(to_convert, quantities):
+            result[name][line_id] = quantity
+        return result
+
+
+class MinimumQuantityShortfall(ModelSQL, ModelView):
+    "Minimum Quantity Shortfall"
+    __name__ = 'purchase.minimum_quantity.shortfall'
+    company = fields.Many2One('company.company', "Company", readonly=True)
+    supplier = fields.Many2One('party.party', "Supplier", readonly=True)
+    product = fields.Many2One('product.product', "Product", readonly=True,
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'})
+    requests = fields.Integer("Requests", readonly=True)
+    lines = fields.Integer("Lines", readonly=True)
+    unit = fields.Many2One('product.uom', "Unit", readonly=True)
+    quantity = fields.Float("Quantity", digits='unit', readonly=True,
+        help="The quantity of the requests and lines below the minimum.")
+    minimum_quantity = fields.Float(
+        "Minimum Quantity", digits='unit', readonly=True)
+    shortfall = fields.Float("Shortfall", digits='unit', readonly=True)
+    currency = fields.Many2One('currency.currency', "Currency", readonly=True)
+    amount = Monetary("Amount", currency='currency', digits='currency',
+        readonly=True,
+        help="The value of the shortfall at the unit price of the lines and "
+        "at the cost price of the product for the requests.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order = [
+            ('supplier', 'ASC'),
+            ('product', 'ASC'),
+            ('id', 'ASC'),
+            ]
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Company = pool.get('company.company')
+        CostPrice = pool.get('product.cost_price')
+        Line = pool.get('purchase.line')
+        Product = pool.get('product.product')
+        ProductSupplier = pool.get('purchase.product_supplier')
+        Purchase = pool.get('purchase.purchase')
+        Request = pool.get('purchase.request')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+        request = Request.__table__()
+        line = Line.__table__()
+        purchase = Purchase.__table__()
+        company = Company.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        default_uom = Uom.__table__()
+        cost_price = CostPrice.__table__()
+
+        def minimum_join(from_, table, party, company, unit):
+            """Join the minimum of the documents of table to from_ and return
+            it with the minimum converted to the unit and the unit tables"""
+            minimum = ProductSupplier.minimum_quantity_query()
+            purchase_uom = Uom.__table__()
+            uom = Uom.__table__()
+            join = from_.join(minimum, condition=(
+                    (minimum.product == table.product)
+                    & (minimum.party == party)
+                    & (minimum.company == company))
+                ).join(purchase_uom,
+                condition=minimum.purchase_uom == purchase_uom.id
+                ).join(uom, condition=unit == uom.id)
+            minimum_quantity = convert_quantity_sql(
+                minimum.minimum_quantity, purchase_uom, uom)
+            return join, minimum, minimum_quantity, purchase_uom, uom
+
+        # The quantities are summed in the purchase unit of the product
+        from_, minimum, minimum_quantity, purchase_uom, uom = minimum_join(
+            line.join(purchase, condition=line.purchase == purchase.id),
+            line, purchase.party, purchase.company, line.unit)
+        lines = from_.select(
+            (line.id * 2 + 1).as_('id'),
+            purchase.company.as_('company'),
+            purchase.party.as_('supplier'),
+            line.product.as_('product'),
+            Literal(0).as_('request'),
+            Literal(1).as_('line'),
+            minimum.purchase_uom.as_('unit'),
+            convert_quantity_sql(line.quantity, uom, purchase_uom
+                ).as_('quantity'),
+            minimum.minimum_quantity.as_('minimum_quantity'),
+            purchase.currency.as_('currency'),
+            ((minimum_quantity - line.quantity) * line.unit_price
+                ).as_('amount'),
+            where=(purchase.state.in_(['draft', 'quotation'])
+                & (line.type == 'line')
+                & (minimum.minimum_quantity != Null)
+                & (line.quantity >= 0)
+                & (line.quantity < minimum_quantity)))
+
+        # The requests are valued at the cost price in the company currency
+        from_, minimum, minimum_quantity, purchase_uom, uom = minimum_join(
+            request.join(company, condition=request.company == company.id
+                ).join(product, condition=request.product == product.id
+                ).join(template, condition=product.template == template.id
+                ).join(default_uom,
+                condition=template.default_uom == default_uom.id
+                ).join(cost_price, 'LEFT', condition=(
+                    (cost_price.product == request.product)
+                    & (cost_price.company == request.company))),
+            request, request.party, request.company, request.unit)
+        requests = from_.select(
+            (request.id * 2).as_('id'),
+            request.company.as_('company'),
+            request.party.as_('supplier'),
+            request.product.as_('product'),
+            Literal(1).as_('request'),
+            Literal(0).as_('line'),
+            minimum.purchase_uom.as_('unit'),
+            convert_quantity_sql(request.quantity, uom, purchase_uom
+                ).as_('quantity'),
+            minimum.minimum_quantity.as_('minimum_quantity'),
+            company.currency.as_('currency'),
+            (convert_quantity_sql(minimum_quantity - request.quantity,
+                    uom, default_uom) * cost_price.cost_price
+                ).as_('amount'),
+            where=((request.purchase_line == Null)
+                & (request.state != 'cancelled')
+                & (minimum.minimum_quantity != Null)
+                & (request.quantity < minimum_quantity)))
 
-        product_supplier = product_suppliers[0]
-        minimum_quantity = product_supplier.minimum_quantity
-        uom_category = self.product.purchase_uom.category
-        if (minimum_quantity and self.unit and
-                    self.unit in uom_category.uoms):
-            return Uom.compute_qty(self.product.purchase_uom,
-                    minimum_quantity, self.unit)
-        return minimum_quantity
+        documents = Union(lines, requests, all_=True)
+        return documents.select(
+            Min(documents.id).as_('id'),
+            Literal(0).as_('create_uid'),
+            CurrentTimestamp().as_('create_date'),
+            cls.write_uid.sql_cast(Literal(Null)).as_('write_uid'),
+            cls.write_date.sql_cast(Literal(Null)).as_('write_date'),
+            documents.company.as_('company'),
+            documents.supplier.as_('supplier'),
+            documents.product.as_('product'),
+            Sum(documents.request).as_('requests'),
+            Sum(documents.line).as_('lines'),
+            documents.unit.as_('unit'),
+            Sum(documents.quantity).as_('quantity'),
+            Max(documents.minimum_quantity).as_('minimum_quantity'),
+            Sum(documents.minimum_quantity - documents.quantity
+                ).as_('shortfall'),
+            documents.currency.as_('currency'),
+            cls.amount.sql_cast(Sum(documents.amount)).as_('amount'),
+            group_by=[
+                documents.company,
+                documents.supplier,
+                documents.product,
+                documents.unit,
+                documents.currency,
+                ])
@@ -0,0 +1,210 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""Benchmark of the minimum quantity hot paths
+
+Run it with the same environment as the tests, for example::
+
+    DB_NAME=:memory: python -m trytond.modules.stock_supply_minimum.tests.benchmark
+
+Each benchmark reports its wall time and the number of queries executed as a
+JSON line. Use --output to keep the results of a commit and --compare to show
+the difference with them.
+"""
+import argparse
+import datetime as dt
+import json
+import sys
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from trytond.modules.account.tests import create_chart
+from trytond.modules.company.tests import create_company, set_company
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, USER, activate_module
+from trytond.transaction import Transaction
+
+from ..instrumentation import count_queries
+
+
+@contextmanager
+def measure(name, results):
+    with count_queries() as queries:
+        start = time.perf_counter()
+        yield
+        duration = time.perf_counter() - start
+    results[name] = {
+        'time': round(duration, 4),
+        'queries': queries[0],
+        }
+    print(json.dumps({'name': name, **results[name]}), flush=True)
+
+
+def create_data(company, templates, suppliers, requests, lines):
+    pool = Pool()
+    Account = pool.get('account.account')
+    Party = pool.get('party.party')
+    ProductCategory = pool.get('product.category')
+    Uom = pool.get('product.uom')
+    Template = pool.get('product.template')
+    ProductSupplier = pool.get('purchase.product_supplier')
+    Location = pool.get('stock.location')
+    Request = pool.get('purchase.request')
+    Purchase = pool.get('purchase.purchase')
+    PurchaseLine = pool.get('purchase.line')
+
+    create_chart(company)
+    expense, = Account.search([
+            ('type.expense', '=', True),
+            ('company', '=', company.id),
+            ], limit=1)
+    revenue, = Account.search([
+            ('type.revenue', '=', True),
+            ('company', '=', company.id),
+            ], limit=1)
+    account_category, = ProductCategory.create([{
+                'name': "Account Category",
+                'accounting': True,
+                'account_expense': expense.id,
+                'account_revenue': revenue.id,
+                }])
+
+    unit, = Uom.search([('name', '=', "Unit")])
+    warehouse, = Location.search([('code', '=', 'WH')])
+    parties = Party.create([
+            {'name': "Supplier %s" % i} for i in range(suppliers)])
+    templates = Template.create([{
+                'name': "Product %s" % i,
+                'type': 'goods',
+                'default_uom': unit.id,
+                'purchasable': True,
+                'purchase_uom': unit.id,
+                'list_price': Decimal(0),
+                'account_category': account_category.id,
+                'products': [('create', [{}])],
+                } for i in range(templates)])
+    ProductSupplier.create([{
+                'template': t.id,
+                'party': parties[i % suppliers].id,
+                'company': company.id,
+                'minimum_quantity': (i % 10) + 1,
+                } for i, t in enumerate(templates)])
+    products = [t.products[0] for t in templates]
+
+    today = dt.date.today()
+    Request.create([{
+                'product': products[i % len(products)].id,
+                'party': parties[i % len(products) % suppliers].id,
+                'quantity': i % 7 + 1,
+                'unit': unit.id,
+                'computed_quantity': i % 7 + 1,
+                'computed_unit': unit.id,
+                'warehouse': warehouse.id,
+                'company': company.id,
+                'origin': 'stock.order_point,-1',
+                'purchase_date': today,
+                'supply_date': today,
+                } for i in range(requests)])
+
+    purchase, = Purchase.create([{
+                'party': parties[0].id,
+                'company': company.id,
+                'currency': company.currency.id,
+                'warehouse': warehouse.id,
+                }])
+    supplier_products = products[::suppliers] or products
+    return purchase, [PurchaseLine(
+            purchase=purchase,
+            type='line',
+            product=supplier_products[i % len(supplier_products)],
+            description="Line %s" % i,
+            quantity=10,
+            unit=unit,
+            unit_price=Decimal(1),
+            ) for i in range(lines)]
+
+
+def run(options):
+    activate_module('stock_supply_minimum')
+    results = {}
+    with Transaction().start(DB_NAME, USER, context={}) as transaction:
+        pool = Pool()
+        Request = pool.get('purchase.request')
+        PurchaseLine = pool.get('purchase.line')
+        CreatePurchase = pool.get(
+            'purchase.request.create_purchase', type='wizard')
+
+        company = create_company()
+        with set_company(company):
+            purchase, lines = create_data(company, options.templates,
+                options.suppliers, options.requests, options.lines)
+
+            request_ids = [r.id for r in Request.search([])]
+            with measure('request_tree_read', results):
+                Request.read(request_ids,
+                    ['product', 'party', 'quantity', 'minimum_quantity'])
+            with measure('search_minimum_quantity', results):
+                Request.search([('minimum_quantity', '>', 5)])
+            with measure('order_minimum_quantity', results):
+                Request.search([], order=[('minimum_quantity', 'DESC')])
+            with measure('line_validation', results):
+                PurchaseLine.save(lines)
+            with measure('line_tree_read', results):
+                PurchaseLine.read([l.id for l in lines],
+                    ['product', 'quantity', 'minimum_quantity'])
+            with measure('line_on_change', results):
+                # Simulate the client calls when editing the lines
+                for line in lines[:options.on_changes]:
+                    PurchaseLine(
+                        product=line.product.id,
+                        unit=line.unit.id,
+                        purchase=purchase.id,
+                        **{'_parent_purchase.party': purchase.party.id},
+                        ).on_change_with(['minimum_quantity'])
+            with measure('create_purchase_wizard', results), \
+                    transaction.set_context(
+                        active_model=Request.__name__,
+                        active_id=request_ids[0],
+                        active_ids=request_ids):
+                session_id, _, _ = CreatePurchase.create()
+                CreatePurchase.execute(session_id, {}, 'start')
+                CreatePurchase.delete(session_id)
+        transaction.rollback()
+    return results
+
+
+def compare(results, reference):
+    for name, result in results.items():
+        if name not in reference:
+            continue
+        before = reference[name]
+        print('%-25s time %8.4f -> %8.4f  queries %6s -> %6s' % (
+                name, before['time'], result['time'],
+                before['queries'], result['queries']))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--templates', type=int, default=1000)
+    parser.add_argument('--suppliers', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--lines', type=int, default=1000)
+    parser.add_argument('--on-changes', type=int, default=200)
+    parser.add_argument('--output', help="file to write the results to")
+    parser.add_argument('--compare', help="file with results to compare to")
+    options = parser.parse_args(args)
+
+    results = run(options)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump({
+                    'options': vars(options),
+                    'results': results,
+                    }, fp, indent=2)
+    if options.compare:
+        with open(options.compare) as fp:
+            compare(results, json.load(fp)['results'])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,10 +3,16 @@ import unittest
 from decimal import Decimal
 
 from proteus import Model, Wizard
-from trytond.modules.account.tests.tools import create_chart, get_accounts
-from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.model.exceptions import DomainValidationError
+from trytond.pool import Pool
 from trytond.tests.test_tryton import drop_db
-from trytond.tests.tools import activate_modules
+from trytond.tests.tools import activate_modules, set_user
+from trytond.transaction import Transaction
+
+from ..instrumentation import count_queries, get_statistics
+from .tools import (
+    create_product_suppliers, create_products, create_requests,
+    create_suppliers, get_base, set_option, setup_base)
 
 
 class Test(unittest.TestCase):
@@ -21,37 +27,13 @@ class Test(unittest.TestCase):
 
     def test(self):
 
-        # Install stock_supply_minimum
-        config = activate_modules('stock_supply_minimum')
-
-        # Create company
-        _ = create_company()
-        company = get_company()
-
-        # Reload the context
-        User = Model.get('res.user')
-        config._context = User.get_preferences(True, config.context)
-
-        # Create chart of accounts
-        _ = create_chart(company)
-        accounts = get_accounts(company)
-        expense = accounts['expense']
-        revenue = accounts['revenue']
-
-        # Create parties
-        Party = Model.get('party.party')
-        supplier = Party(name='Supplier')
-        supplier.save()
-        customer = Party(name='Customer')
-        customer.save()
-
-        # Create account category
-        ProductCategory = Model.get('product.category')
-        account_category = ProductCategory(name="Account Category")
-        account_category.accounting = True
-        account_category.account_expense = expense
-        account_category.account_revenue = revenue
-        account_category.save()
+        # Restore the database with the module and the base data
+        activate_modules('stock_supply_minimum', setup_base)
+        base = get_base()
+        company = base['company']
+        supplier = base['supplier']
+        customer = base['customer']
+        account_category = base['account_category']
 
         # Base data
         ProductUom = Model.get('product.uom')
@@ -137,3 +119,588 @@ class Test(unittest.TestCase):
 
         self.assertEqual(lines_by_product[product_minimum.id].quantity, 10.0)
         self.assertEqual(lines_by_product[product_raise.id].quantity, 12.0)
+
+    def test_volume(self):
+
+        # Restore the database with the module and the base data
+        config = activate_modules('stock_supply_minimum', setup_base)
+        base = get_base()
+
+        # Create the products, suppliers and requests in bulk
+        suppliers = create_suppliers(5)
+        products = create_products(100, base['account_category'])
+        create_product_suppliers(products, suppliers, lambda i: i % 10 + 1)
+        requests = create_requests(
+            products, suppliers, 3, base['warehouse'])
+
+        PurchaseRequest = Model.get('purchase.request')
+        self.assertEqual(
+            len(PurchaseRequest.find([('minimum_quantity', '>', 3)])), 70)
+
+        # Lookup the minimum quantities in one call
+        ProductSupplier = Model.get('purchase.product_supplier')
+        minimums = ProductSupplier._proxy.lookup_minimum_quantities(
+            [(p.id, suppliers[i % 5].id, base['unit'].id)
+                for i, p in enumerate(products[:3])]
+            + [(products[0].id, suppliers[1].id, None)],
+            config.context)
+        self.assertEqual(
+            [m and m['minimum_quantity'] for m in minimums],
+            [1.0, 2.0, 3.0, None])
+
+        # Create the purchases and check minimum quantities
+        Wizard('purchase.request.create_purchase', requests)
+
+        PurchaseLine = Model.get('purchase.line')
+        lines = PurchaseLine.find([])
+        self.assertEqual(len(lines), 100)
+        self.assertEqual(
+            sorted(l.quantity for l in lines),
+            sorted(max(3, i % 10 + 1) for i in range(100)))
+
+    def test_line_validation(self):
+
+        # Restore the database with the module and the base data
+        activate_modules('stock_supply_minimum', setup_base)
+        base = get_base()
+        products = create_products(3, base['account_category'])
+        create_product_suppliers(products, [base['supplier']], 5)
+
+        # Lines below the minimum are all reported at once
+        Purchase = Model.get('purchase.purchase')
+        purchase = Purchase()
+        purchase.party = base['supplier']
+        for product in products:
+            line = purchase.lines.new()
+            line.product = product
+            line.quantity = 2
+            line.unit_price = Decimal('1')
+        with self.assertRaises(DomainValidationError) as cm:
+            purchase.save()
+        for product in products:
+            self.assertIn(product.rec_name, str(cm.exception))
+
+        # Lines at the minimum are valid
+        for line in purchase.lines:
+            line.quantity = 5
+        purchase.save()
+        self.assertEqual(purchase.state, 'draft')
+
+        # Negative quantities are not checked
+        line = purchase.lines.new()
+        line.product = products[0]
+        line.quantity = -1
+        line.unit_price = Decimal('1')
+        purchase.save()
+
+    def test_stored_minimum_quantity(self):
+
+        # Store the minimum quantity on the requests
+        set_option(self, 'store_minimum_quantity', True)
+
+        # Restore the database with the module and the base data
+        activate_modules('stock_supply_minimum', setup_base)
+        base = get_base()
+        products = create_products(2, base['account_category'])
+        product_supplier, _ = create_product_suppliers(
+            products, [base['supplier']], 5)
+        create_requests(products, [base['supplier']], 3, base['warehouse'])
+
+        PurchaseRequest = Model.get('purchase.request')
+        self.assertEqual(
+            [r.supplier_minimum_quantity
+                for r in PurchaseRequest.find([], order=[('id', 'ASC')])],
+            [5, 5])
+
+        # Create a purchase user
+        User = Model.get('res.user')
+        Group = Model.get('res.group')
+        admin, = User.find([('login', '=', 'admin')])
+        purchase_user = User(name="Purchase", login='purchase')
+        purchase_group, = Group.find([('name', '=', "Purchase")])
+        purchase_user.groups.append(purchase_group)
+        purchase_user.companies.append(base['company'])
+        purchase_user.company = base['company']
+        purchase_user.save()
+
+        # The purchase user changes the minimum quantity
+        set_user(purchase_user)
+        ProductSupplier = Model.get('purchase.product_supplier')
+        product_supplier = ProductSupplier(product_supplier.id)
+        product_supplier.minimum_quantity = 8
+        product_supplier.save()
+
+        # The stored minimum quantity of the request is updated
+        set_user(admin)
+        self.assertEqual(
+            [r.supplier_minimum_quantity
+                for r in PurchaseRequest.find([], order=[('id', 'ASC')])],
+            [8, 5])
+        self.assertEqual(len(PurchaseRequest.find(
+                    [('supplier_minimum_quantity', '>', 6)])), 1)
+
+    def test_search_order_minimum_quantity(self):
+
+        # Restore the database with the module and the base data
+        activate_modules('stock_supply_minimum', setup_base)
+        base = get_base()
+        supplier = base['supplier']
+
+        # Create purchase units accurate on factor and on rate
+        Uom = Model.get('product.uom')
+        dozen, = Uom.find([('name', '=', "Dozen")])
+        third = Uom(name="Third", symbol="1/3")
+        third.category = base['unit'].category
+        third.rate = 3
+        third.accurate_field = 'rate'
+        third.rounding = 0.01
+        third.save()
+
+        # Create products purchased by unit, dozen and third
+        products = create_products(3, base['account_category'])
+        for product, purchase_uom in zip(products[1:], [dozen, third]):
+            template = product.template
+            template.purchase_uom = purchase_uom
+            template.save()
+        create_product_suppliers(products, [supplier], [30, 2, 10].__getitem__)
+        requests = create_requests(products, [supplier], 1, base['warehouse'])
+
+        # The minimum quantities are converted to the unit of the requests
+        self.assertEqual(
+            [r.minimum_quantity for r in requests], [30, 24, 3])
+
+        # Searching and ordering in SQL agree with the getter
+        PurchaseRequest = Model.get('purchase.request')
+        for request in requests:
+            self.assertEqual(PurchaseRequest.find([
+                        ('minimum_quantity', '=', request.minimum_quantity),
+                        ]), [request])
+        self.assertEqual(
+            PurchaseRequest.find([('minimum_quantity', '>', 3)],
+                order=[('minimum_quantity', 'ASC')]),
+            [requests[1], requests[0]])
+        self.assertEqual(
+            PurchaseRequest.find([], order=[('minimum_quantity', 'ASC')]),
+            requests[::-1])
+
+    def test_refresh_minimum_quantity(self):
+
+        # Restore the database with the module and the base data
+        activate_modules('stock_supply_minimum', setup_base)
+        base = get_base()
+        products = create_products(2, base['account_category'])
+        product_suppliers = create_product_suppliers(
+            products, [base['supplier']], 5)
+        request, = create_requests(
+            products[1:], [base['supplier']], 3, base['warehouse'])
+
+        # Create a purchase at the minimum quantities
+        Purchase = Model.get('purchase.purchase')
+        purchase = Purchase()
+        purchase.party = base['supplier']
+        for product in products:
+            line = purchase.lines.new()
+            line.product = product
+            line.quantity = 5
+            line.unit_price = Decimal('1')
+        purchase.save()
+        first_line, second_line = purchase.lines
+
+        PurchaseLine = Model.get('purchase.line')
+        self.assertEqual(PurchaseLine.find([('invalid_quantity', '=', True)]),
+            [])
+
+        # By default the lines are not refreshed but flagged
+        first_supplier, second_supplier = product_suppliers
+        first_supplier.minimum_quantity = 10
+        first_supplier.save()
+        first_line.reload()
+        self.assertEqual(first_line.quantity, 5)
+        self.assertTrue(first_line.invalid_quantity)
+        self.assertEqual(PurchaseLine.find([('invalid_quantity', '=', True)]),
+            [first_line])
+        self.assertEqual(
+            PurchaseLine.find([('invalid_quantity', '=', False)]),
+            [second_line])
+
+        # The flag mode keeps the quantities
+        set_option(self, 'refresh_minimum_quantity', 'flag')
+        first_supplier.minimum_quantity = 8
+        first_supplier.save()
+        first_line.reload()
+        self.assertEqual(first_line.quantity, 5)
+        self.assertTrue(first_line.invalid_quantity)
+
+        # The adjust mode raises the lines and the requests to the minimum
+        set_option(self, 'refresh_minimum_quantity', 'adjust')
+        second_supplier.minimum_quantity = 12
+        second_supplier.save()
+        second_line.reload()
+        request.reload()
+        self.assertEqual(second_line.quantity, 12)
+        self.assertFalse(second_line.invalid_quantity)
+        self.assertEqual(request.quantity, 12)
+
+    def test_import_export_minimum_quantity(self):
+
+        # Restore the database with the module and the base data
+        activate_modules('stock_supply_minimum', setup_base)
+        base = get_base()
+        supplier = base['supplier']
+        product, = create_products(1, base['account_category'])
+        product.suffix_code = 'P'
+        product.save()
+        create_product_suppliers([product], [supplier], 5)
+
+        # Create a template with two variants
+        Template = Model.get('product.template')
+        template = Template(name="Variants")
+        template.type = 'goods'
+        template.default_uom = base['unit']
+        template.purchasable = True
+        template.purchase_uom = base['unit']
+        template.list_price = Decimal(0)
+        template.account_category = base['account_category']
+        variant_a, = template.products
+        variant_a.suffix_code = 'A'
+        variant_b = template.products.new()
+        variant_b.suffix_code = 'B'
+        template.save()
+        variant_a, variant_b = template.products
+
+        # Import the minimum quantities
+        code = supplier.code
+        rows = [
+            ['product', 'supplier', 'minimum'],
+            ['P', code, '7'],
+            ['P', code, '9'],
+            ['A', code, '3'],
+            ['B', code, '4'],
+            ['P', code, 'nan'],
+            ['P', code, 'inf'],
+            ['P', code, '-1'],
+            ['X', code, '1'],
+            ]
+        import_ = Wizard('purchase.product_supplier.import_minimum_quantity')
+        import_.form.file = '\n'.join(map(','.join, rows)).encode('utf-8')
+        import_.execute('import_')
+        self.assertEqual(import_.form.imported, 4)
+        self.assertEqual(import_.form.rejected, 4)
+        self.assertEqual(
+            len(import_.form.rejected_file.decode('utf-8').splitlines()), 4)
+
+        # The last row wins and the variants get their own supplier
+        ProductSupplier = Model.get('purchase.product_supplier')
+        self.assertEqual(
+            [(s.product, s.minimum_quantity)
+                for s in ProductSupplier.find([], order=[('id', 'ASC')])],
+            [(product, 9), (variant_a, 3), (variant_b, 4)])
+
+        # Export the minimum quantities
+        export = Wizard('purchase.product_supplier.export_minimum_quantity')
+        self.assertEqual(export.form.file.decode('utf-8').splitlines(), [
+                'product_code,party_code,minimum_quantity',
+                'P,%s,9.0' % code,
+                'A,%s,3.0' % code,
+                'B,%s,4.0' % code,
+                ])
+
+    def test_minimum_quantity_shortfall(self):
+
+        # Restore the database with the module and the base data
+        activate_modules('stock_supply_minimum', setup_base)
+        base = get_base()
+        supplier = base['supplier']
+        products = create_products(2, base['account_category'])
+        for product in products:
+            product.cost_price = Decimal('2')
+            product.save()
+        product_suppliers = create_product_suppliers(
+            products, [supplier], [10, 1].__getitem__)
+        create_requests(
+            products[:1] * 2 + products[1:], [supplier],
+            [3, 4, 5].__getitem__, base['warehouse'])
+
+        # Create a purchase line at the minimum which is raised
+        Purchase = Model.get('purchase.purchase')
+        purchase = Purchase()
+        purchase.party = supplier
+        line = purchase.lines.new()
+        line.product = products[0]
+        line.quantity = 10
+        line.unit_price = Decimal('3')
+        purchase.save()
+        product_supplier = product_suppliers[0]
+        product_supplier.minimum_quantity = 12
+        product_supplier.save()
+
+        # The requests and the line are summed by supplier and product
+        Shortfall = Model.get('purchase.minimum_quantity.shortfall')
+        shortfall, = Shortfall.find([])
+        self.assertEqual(shortfall.supplier, supplier)
+        self.assertEqual(shortfall.product, products[0])
+        self.assertEqual(shortfall.requests, 2)
+        self.assertEqual(shortfall.lines, 1)
+        self.assertEqual(shortfall.unit, base['unit'])
+        self.assertEqual(shortfall.quantity, 17)
+        self.assertEqual(shortfall.minimum_quantity, 12)
+        self.assertEqual(shortfall.shortfall, 19)
+        self.assertEqual(shortfall.currency, base['company'].currency)
+        self.assertEqual(shortfall.amount, Decimal('40'))
+
+    def test_minimum_amount(self):
+
+        # Restore the database with the module and the base data
+        activate_modules('stock_supply_minimum', setup_base)
+        base = get_base()
+        supplier = base['supplier']
+        product, = create_products(1, base['account_category'])
+
+        # Set the minimum amount of the supplier for the company
+        supplier.purchase_minimum_amount = Decimal('100')
+        supplier.save()
+        self.assertEqual(
+            supplier.purchase_minimum_amount_currency,
+            base['company'].currency)
+
+        # Create a currency worth the half of the company currency
+        Currency = Model.get('currency.currency')
+        currency = Currency(name="Half", code='HLF', symbol="H")
+        rate = currency.rates.new()
+        rate.date = datetime.date.min
+        rate.rate = Decimal('2')
+        currency.save()
+
+        # Create purchases below the minimum amount in both currencies
+        Purchase = Model.get('purchase.purchase')
+        purchases = []
+        for purchase_currency, quantity in [
+                (base['company'].currency, 40),
+                (base['company'].currency, 150),
+                (currency, 150),
+                ]:
+            purchase = Purchase()
+            purchase.party = supplier
+            purchase.currency = purchase_currency
+            line = purchase.lines.new()
+            line.product = product
+            line.quantity = quantity
+            line.unit_price = Decimal('1')
+            purchase.save()
+            purchases.append(purchase)
+
+        # The minimum is converted to the currency of the purchase
+        self.assertEqual(
+            [p.minimum_amount_shortfall for p in purchases],
+            [Decimal('60'), None, Decimal('50')])
+        self.assertEqual(
+            Purchase.find([('minimum_amount_shortfall', '>', 55)]),
+            [purchases[0]])
+        self.assertEqual(
+            Purchase.find([('minimum_amount_shortfall', '!=', None)],
+                order=[('id', 'ASC')]),
+            [purchases[0], purchases[2]])
+        self.assertEqual(
+            Purchase.find([('minimum_amount_shortfall', '=', None)]),
+            [purchases[1]])
+
+    def test_purchase_multiple(self):
+
+        # Restore the database with the module and the base data
+        activate_modules('stock_supply_minimum', setup_base)
+        base = get_base()
+        supplier = base['supplier']
+        products = create_products(2, base['account_category'])
+        create_product_suppliers(
+            products, [supplier], [5, None].__getitem__,
+            purchase_multiple=4)
+        requests = create_requests(
+            products, [supplier], [3, 9].__getitem__, base['warehouse'])
+
+        # The wizard raises to the minimum and then to the next multiple
+        Wizard('purchase.request.create_purchase', requests)
+        PurchaseLine = Model.get('purchase.line')
+        self.assertEqual(
+            [l.quantity
+                for l in PurchaseLine.find([], order=[('product', 'ASC')])],
+            [8, 12])
+
+        # The lines must be a multiple of the purchase multiple
+        line = PurchaseLine.find([], order=[('product', 'ASC')])[0]
+        self.assertEqual(line.purchase_multiple, 4)
+        line.quantity = 10
+        with self.assertRaises(DomainValidationError) as cm:
+            line.save()
+        self.assertIn(line.rec_name, str(cm.exception))
+        line.quantity = 16
+        line.save()
+
+    def test_optimize_supplier(self):
+
+        # Choose the supplier with the lowest cost
+        set_option(self, 'optimize_supplier', True)
+
+        # Restore the database with the module and the base data
+        activate_modules('stock_supply_minimum', setup_base)
+        base = get_base()
+        cheap, expensive = create_suppliers(2)
+        products = create_products(2, base['account_category'])
+
+        def prices(unit_price):
+            return [('create', [{
+                            'quantity': 0,
+                            'unit_price': Decimal(unit_price),
+                            }])]
+        create_product_suppliers(
+            products, [cheap], [100, 1].__getitem__, prices=prices('1'))
+        create_product_suppliers(
+            products, [expensive], 0, prices=prices('2'))
+        requests = create_requests(products, [cheap], 10, base['warehouse'])
+
+        # The minimum of the cheap supplier costs more on the first product
+        Wizard('purchase.request.create_purchase', requests)
+        for request in requests:
+            request.reload()
+        self.assertEqual(
+            [r.party for r in requests], [expensive, cheap])
+        self.assertEqual(
+            [(r.purchase_line.purchase.party, r.purchase_line.quantity)
+                for r in requests],
+            [(expensive, 10), (cheap, 10)])
+
+    def test_line_on_change(self):
+
+        # Restore the database with the module and the base data
+        activate_modules('stock_supply_minimum', setup_base)
+        base = get_base()
+        product, = create_products(1, base['account_category'])
+        create_product_suppliers(
+            [product], [base['supplier']], 5, purchase_multiple=2)
+
+        # The client computes the minimums when the product is set
+        Purchase = Model.get('purchase.purchase')
+        purchase = Purchase()
+        purchase.party = base['supplier']
+        line = purchase.lines.new()
+        line.product = product
+        self.assertEqual(line.minimum_quantity, 5)
+        self.assertEqual(line.purchase_multiple, 2)
+
+        # And when the unit is changed
+        Uom = Model.get('product.uom')
+        dozen, = Uom.find([('name', '=', "Dozen")])
+        line.unit = dozen
+        self.assertAlmostEqual(line.minimum_quantity, 0.42)
+
+    def test_create_purchase_chunk(self):
+
+        # Create the purchases by chunks of 2 requests
+        set_option(self, 'create_purchase_chunk', 2)
+
+        # Restore the database with the module and the base data
+        activate_modules('stock_supply_minimum', setup_base)
+        base = get_base()
+        suppliers = create_suppliers(3)
+        products = create_products(5, base['account_category'])
+        create_product_suppliers(products, suppliers[:1], 5)
+        requests = create_requests(
+            products, [suppliers[0]] * 3 + suppliers[1:], 3,
+            base['warehouse'])
+
+        # The requests of the first supplier are not split
+        create_purchase = Wizard('purchase.request.create_purchase', requests)
+        self.assertEqual(create_purchase.state, 'queued')
+        self.assertEqual(create_purchase.form.requests, 5)
+        self.assertEqual(create_purchase.form.chunks, 2)
+        create_purchase.execute('end')
+
+        # The chunks are run by the queue at the commit
+        for request in requests:
+            request.reload()
+        purchases = {}
+        for request in requests:
+            purchases.setdefault(request.party, set()).add(
+                request.purchase_line.purchase)
+        self.assertEqual(
+            {p: len(s) for p, s in purchases.items()},
+            {s: 1 for s in suppliers})
+        self.assertEqual(
+            [r.purchase_line.quantity for r in requests], [5, 5, 5, 3, 3])
+
+    def test_generate_minimum_quantity(self):
+
+        # Raise the generated requests to the supplier minimum
+        set_option(self, 'generate_minimum_quantity', True)
+
+        # Restore the database with the module and the base data
+        activate_modules('stock_supply_minimum', setup_base)
+        base = get_base()
+        company = base['company']
+        product, = create_products(1, base['account_category'])
+        create_product_suppliers([product], [base['supplier']], 12)
+
+        # Create a need of 10 units
+        Location = Model.get('stock.location')
+        customer_loc, = Location.find([('code', '=', 'CUS')])
+        output_loc, = Location.find([('code', '=', 'OUT')])
+        ShipmentOut = Model.get('stock.shipment.out')
+        shipment_out = ShipmentOut()
+        shipment_out.planned_date = datetime.date.today()
+        shipment_out.customer = base['customer']
+        shipment_out.warehouse = base['warehouse']
+        shipment_out.company = company
+        move = shipment_out.outgoing_moves.new()
+        move.product = product
+        move.unit = base['unit']
+        move.quantity = 10
+        move.from_location = output_loc
+        move.to_location = customer_loc
+        move.company = company
+        move.unit_price = Decimal('1')
+        move.currency = company.currency
+        shipment_out.click('wait')
+
+        # The quantity is raised but the computed quantity keeps the need
+        create_pr = Wizard('stock.supply')
+        create_pr.execute('create_')
+        PurchaseRequest = Model.get('purchase.request')
+        request, = PurchaseRequest.find([('state', '=', 'draft')])
+        self.assertEqual(request.product, product)
+        self.assertEqual(request.quantity, 12)
+        self.assertEqual(request.computed_quantity, 10)
+        self.assertEqual(request.minimum_quantity, 12)
+
+    def test_instrumentation(self):
+
+        # Count the calls and the queries of the minimum quantity lookups
+        set_option(self, 'instrumentation', True)
+
+        # Restore the database with the module and the base data
+        config = activate_modules('stock_supply_minimum', setup_base)
+        base = get_base()
+        products = create_products(2, base['account_category'])
+        create_product_suppliers(products, [base['supplier']], 5)
+        keys = [(p.id, base['supplier'].id, base['company'].id)
+            for p in products]
+
+        with Transaction().start(config.database_name, config.user,
+                context=config.context):
+            ProductSupplier = Pool().get('purchase.product_supplier')
+            ProductSupplier._minimum_quantity_cache.clear()
+            name = 'product_supplier.get_minimum_quantities'
+
+            # The first lookup queries the database
+            with count_queries() as queries:
+                ProductSupplier.get_minimum_quantities(keys)
+            statistics = get_statistics()
+            self.assertEqual(statistics['%s.calls' % name], 1)
+            self.assertEqual(statistics['product_supplier.cache_misses'], 2)
+            self.assertGreaterEqual(statistics['%s.queries' % name], 1)
+            self.assertEqual(statistics['%s.queries' % name], queries[0])
+
+            # The second lookup reads the cache
+            with count_queries() as queries:
+                ProductSupplier.get_minimum_quantities(keys)
+            self.assertEqual(statistics['%s.calls' % name], 2)
+            self.assertEqual(statistics['product_supplier.cache_misses'], 2)
+            self.assertEqual(queries[0], 0)
@@ -0,0 +1,185 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""Fixtures of the stock_supply_minimum scenarios
+
+setup_base is meant to be passed to activate_modules so the database with the
+module activated and the base data is saved in the DB_CACHE directory (a file
+copy on SQLite and a template database on PostgreSQL) and restored by the next
+tests instead of being created again::
+
+    config = activate_modules('stock_supply_minimum', setup_base)
+
+The factories create many records with a single call to the server.
+"""
+import datetime as dt
+from decimal import Decimal
+
+from proteus import Model
+from proteus.config import get_config
+from trytond.config import config as trytond_config
+from trytond.modules.account.tests.tools import create_chart, get_accounts
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.transaction import Transaction
+
+
+def setup_base(config):
+    "Create the company, the chart of accounts, the parties and the category"
+    Party = Model.get('party.party', config=config)
+    ProductCategory = Model.get('product.category', config=config)
+
+    create_company(config=config)
+    company = get_company(config=config)
+    create_chart(company, config=config)
+    accounts = get_accounts(company, config=config)
+
+    Party.save([Party(name='Supplier'), Party(name='Customer')])
+
+    account_category = ProductCategory(name="Account Category")
+    account_category.accounting = True
+    account_category.account_expense = accounts['expense']
+    account_category.account_revenue = accounts['revenue']
+    account_category.save()
+
+
+def get_base(config=None):
+    "Return a dictionary with the records created by setup_base"
+    Party = Model.get('party.party', config=config)
+    ProductCategory = Model.get('product.category', config=config)
+    Uom = Model.get('product.uom', config=config)
+    Location = Model.get('stock.location', config=config)
+
+    supplier, = Party.find([('name', '=', 'Supplier')])
+    customer, = Party.find([('name', '=', 'Customer')])
+    account_category, = ProductCategory.find(
+        [('name', '=', "Account Category")])
+    unit, = Uom.find([('name', '=', 'Unit')])
+    warehouse, = Location.find([('code', '=', 'WH')])
+    return {
+        'company': get_company(config=config),
+        'supplier': supplier,
+        'customer': customer,
+        'account_category': account_category,
+        'unit': unit,
+        'warehouse': warehouse,
+        }
+
+
+def create_suppliers(count, config=None):
+    "Create count supplier parties"
+    Party = Model.get('party.party', config=config)
+    return _find(Party, _create(Party, [
+                {'name': "Supplier %s" % i} for i in range(count)],
+            config))
+
+
+def create_products(count, account_category, unit=None, config=None):
+    "Create count purchasable goods and return their variants"
+    Template = Model.get('product.template', config=config)
+    Product = Model.get('product.product', config=config)
+    if unit is None:
+        Uom = Model.get('product.uom', config=config)
+        unit, = Uom.find([('name', '=', 'Unit')])
+    template_ids = _create(Template, [{
+                'name': "Product %s" % i,
+                'type': 'goods',
+                'default_uom': unit.id,
+                'purchasable': True,
+                'purchase_uom': unit.id,
+                'list_price': Decimal(0),
+                'account_category': account_category.id,
+                'products': [('create', [{}])],
+                } for i in range(count)], config)
+    return Product.find([('template', 'in', template_ids)], order=[
+            ('template', 'ASC')])
+
+
+def create_product_suppliers(
+        products, suppliers, minimum_quantity, company=None, config=None,
+        **values):
+    """Create a product supplier for each product
+
+    The suppliers are assigned in turn and minimum_quantity is a value or a
+    function of the index returning the minimum quantity.
+    """
+    ProductSupplier = Model.get('purchase.product_supplier', config=config)
+    if company is None:
+        company = get_company(config=config)
+    if not callable(minimum_quantity):
+        minimum_quantity = _constant(minimum_quantity)
+    return _find(ProductSupplier, _create(ProductSupplier, [{
+                    'template': p.template.id,
+                    'product': p.id,
+                    'party': suppliers[i % len(suppliers)].id,
+                    'company': company.id,
+                    'minimum_quantity': minimum_quantity(i),
+                    **values,
+                    } for i, p in enumerate(products)], config))
+
+
+def create_requests(
+        products, suppliers, quantity, warehouse, company=None, config=None,
+        **values):
+    """Create a draft purchase request for each product
+
+    The suppliers are assigned in turn and quantity is a value or a function
+    of the index returning the quantity in the default unit of the product.
+    The requests are created on the server as stock_supply does because the
+    users are not allowed to create them.
+    """
+    Request = Model.get('purchase.request', config=config)
+    if config is None:
+        config = get_config()
+    if company is None:
+        company = get_company(config=config)
+    if not callable(quantity):
+        quantity = _constant(quantity)
+    today = dt.date.today()
+    vlist = [{
+            'product': p.id,
+            'party': suppliers[i % len(suppliers)].id,
+            'quantity': quantity(i),
+            'unit': p.default_uom.id,
+            'computed_quantity': quantity(i),
+            'computed_unit': p.default_uom.id,
+            'warehouse': warehouse.id,
+            'company': company.id,
+            'origin': 'stock.order_point,-1',
+            'purchase_date': today,
+            'supply_date': today,
+            **values,
+            } for i, p in enumerate(products)]
+    with Transaction().start(config.database_name, config.user,
+            context=config.context) as transaction:
+        ids = [r.id for r in config.pool.get('purchase.request').create(vlist)]
+        transaction.commit()
+    return _find(Request, ids)
+
+
+def set_option(testcase, name, value):
+    """Set the stock_supply_minimum option of the trytond configuration for
+    the duration of the test"""
+    section = 'stock_supply_minimum'
+    if not trytond_config.has_section(section):
+        trytond_config.add_section(section)
+    if trytond_config.has_option(section, name):
+        testcase.addCleanup(trytond_config.set, section, name,
+            trytond_config.get(section, name))
+    else:
+        testcase.addCleanup(trytond_config.remove_option, section, name)
+    trytond_config.set(section, name, str(value))
+
+
+def _find(model, ids):
+    "Return the records of the ids in the same order"
+    return model.find([('id', 'in', ids)], order=[('id', 'ASC')])
+
+
+def _create(model, vlist, config):
+    "Create the records of vlist with one call and return their ids"
+    if config is None:
+        config = get_config()
+    return model._proxy.create(vlist, config.context)
+
+
+def _constant(value):
+    return lambda i: value